@@ -0,0 +1,100 @@
+"""Buffered audit log writer.
+
+``record`` only appends to a bounded in-memory queue, so request handlers
+never wait on the audit table. A background thread drains the queue and
+writes events with one bulk INSERT per batch. When the queue is full, new
+events are dropped and counted rather than blocking the caller. ``shutdown``
+flushes whatever is still buffered.
+"""
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from . import database, crud
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 0.5))
+
+logger = logging.getLogger(__name__)
+
+
+class AuditWriter:
+    def __init__(self, maxsize: int, batch_size: int, interval: float):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def record(self, actor: str, action: str, target: str = None, detail: str = None) -> bool:
+        """Buffer an event; returns False if it was dropped because the queue is full."""
+        self._ensure_started()
+        event = {"actor": actor, "action": action, "target": target, "detail": detail, "created_at": datetime.now(timezone.utc)}
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self) -> int:
+        """Write everything buffered so far; returns the number of events written."""
+        total = 0
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return total
+                db = database.SessionLocal()
+                try:
+                    crud.create_audits(db, batch)
+                except Exception:
+                    logger.exception("Dropping %d audit events after a failed write", len(batch))
+                    self.dropped += len(batch)
+                    continue
+                finally:
+                    db.close()
+                total += len(batch)
+                self.written += len(batch)
+
+    def shutdown(self):
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+
+writer = AuditWriter(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL)
+
+
+def record(actor: str, action: str, target: str = None, detail: str = None) -> bool:
+    return writer.record(actor, action, target, detail)
@@ -1,20 +1,27 @@
 import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 import jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 from . import models, database
+from .hashing import pwd_context
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key-change-me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60 * 24))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 7))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 1024))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 30))
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 
 def get_password_hash(password: str) -> str:
@@ -41,6 +48,66 @@ def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+@dataclass(frozen=True)
+class Principal:
+    """Snapshot of the user fields request handlers read from ``current_user``."""
+    id: int
+    username: str
+    role: str
+
+
+class PrincipalCache:
+    """Bounded LRU of resolved principals by username, with a TTL per entry.
+
+    Per process: ``invalidate`` only reaches this worker's cache, so other
+    workers may serve a changed role or username for up to ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, principal: Principal):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[principal.username] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "ttl_seconds": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+principal_cache = PrincipalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+
 def get_db():
     db = database.SessionLocal()
     try:
@@ -49,8 +116,26 @@ def get_db():
         db.close()
 
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    token = credentials.credentials
+def get_read_db():
+    """Session on the read replica (or SQLite read pool) for GET endpoints."""
+    db = database.ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    async with database.get_async_session_factory()() as db:
+        yield db
+
+
+async def get_async_read_db():
+    async with database.get_async_session_factory(readonly=True)() as db:
+        yield db
+
+
+def _username_from_token(token: str) -> str:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -58,15 +143,58 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     except jwt.PyJWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return username
+
+
+def token_subject(token: str) -> Optional[str]:
+    """Username a valid access token was issued to, or None; never raises."""
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except jwt.PyJWTError:
+        return None
 
-    user = db.query(models.User).filter(models.User.username == username).first()
+
+def _principal_for(user: Optional[models.User]) -> Principal:
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return user
+    principal = Principal(id=user.id, username=user.username, role=user.role)
+    principal_cache.put(principal)
+    return principal
+
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    username = _username_from_token(credentials.credentials)
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    return _principal_for(db.query(models.User).filter(models.User.username == username).first())
+
+
+async def get_current_user_async(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Event-loop variant of ``get_current_user``; only opens a session on a cache miss."""
+    return await _principal_from_token(credentials.credentials)
+
+
+async def get_stream_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security), access_token: Optional[str] = Query(None, description="for clients such as EventSource that cannot send headers")):
+    """Like ``get_current_user_async``, but also accepts the token as a query parameter."""
+    token = credentials.credentials if credentials else access_token
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    return await _principal_from_token(token)
+
+
+async def _principal_from_token(token: str) -> Principal:
+    username = _username_from_token(token)
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    async with database.get_async_session_factory(readonly=True)() as db:
+        result = await db.execute(select(models.User).where(models.User.username == username))
+        return _principal_for(result.scalars().first())
 
 
 def require_role(role: str):
-    def _require(current_user: models.User = Depends(get_current_user)):
+    def _require(current_user: Principal = Depends(get_current_user)):
         if current_user.role != role:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient permissions")
         return current_user
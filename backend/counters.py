@@ -0,0 +1,34 @@
+"""Verify or rebuild the per-user category counters behind /api/stats.
+
+Usage:
+    python -m backend.counters verify [--owner ID]
+    python -m backend.counters rebuild [--owner ID]
+"""
+import argparse
+import sys
+from . import database, crud
+
+
+def run(command: str, owner_id: int = None) -> int:
+    db = database.SessionLocal()
+    try:
+        if command == "rebuild":
+            written = crud.rebuild_category_counts(db, owner_id)
+            print(f"Rebuilt {written} category counters")
+            return 0
+        mismatches = crud.verify_category_counts(db, owner_id)
+        for (owner, category), (stored, actual) in sorted(mismatches.items()):
+            print(f"owner={owner} category={category!r}: stored={stored} actual={actual}")
+        print("Counters OK" if not mismatches else f"{len(mismatches)} mismatched counters")
+        return 1 if mismatches else 0
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["verify", "rebuild"])
+    parser.add_argument("--owner", type=int, default=None, help="limit to one user id")
+    args = parser.parse_args()
+    database.init_db()
+    sys.exit(run(args.command, args.owner))
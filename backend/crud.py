@@ -1,14 +1,20 @@
-from sqlalchemy.orm import Session
-from . import models
-from .auth import get_password_hash, verify_password, create_access_token
+import base64
+import json
+from datetime import datetime, timezone
+from collections import Counter
+from sqlalchemy import case, delete, exists, func, insert, literal, select, tuple_, union, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, aliased
+from . import events, models, search
+from .auth import get_password_hash, verify_password, create_access_token, principal_cache
 
 
 def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 
-def create_user(db: Session, username: str, password: str, role: str = "user"):
-    hashed = get_password_hash(password)
+def create_user(db: Session, username: str, password: str = None, role: str = "user", hashed_password: str = None):
+    hashed = hashed_password or get_password_hash(password)
     user = models.User(username=username, hashed_password=hashed, role=role)
     db.add(user)
     db.commit()
@@ -25,71 +31,410 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 
+def set_user_password_hash(db: Session, user_id: int, hashed_password: str):
+    db.query(models.User).filter(models.User.id == user_id).update({models.User.hashed_password: hashed_password})
+    db.commit()
+
+
+def _bump_category_count(db: Session, owner_id: int, category: str, delta: int):
+    """Adjust a category counter inside the caller's transaction."""
+    table = models.CategoryCount.__table__
+    dialect = db.bind.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert
+        stmt = insert(table).values(owner_id=owner_id, category=category, count=delta)
+        db.execute(stmt.on_conflict_do_update(index_elements=[table.c.owner_id, table.c.category], set_={"count": table.c.count + delta}))
+        return
+    updated = db.query(models.CategoryCount).filter(models.CategoryCount.owner_id == owner_id, models.CategoryCount.category == category).update({models.CategoryCount.count: models.CategoryCount.count + delta}, synchronize_session=False)
+    if not updated:
+        db.add(models.CategoryCount(owner_id=owner_id, category=category, count=delta))
+        db.flush()
+
+
+def bump_data_version(db: Session, user_id: int):
+    """Mark a user's items as changed, inside the caller's transaction."""
+    table = models.DataVersion.__table__
+    dialect = db.bind.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert
+        stmt = insert(table).values(user_id=user_id, version=1)
+        db.execute(stmt.on_conflict_do_update(index_elements=[table.c.user_id], set_={"version": table.c.version + 1}))
+        return
+    updated = db.query(models.DataVersion).filter(models.DataVersion.user_id == user_id).update({models.DataVersion.version: models.DataVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db.add(models.DataVersion(user_id=user_id, version=1))
+        db.flush()
+
+
+def get_data_version(db: Session, user_id: int) -> int:
+    version = db.query(models.DataVersion.version).filter(models.DataVersion.user_id == user_id).scalar()
+    return version or 0
+
+
+def get_item_data_version(db: Session, item_id: int):
+    """``(owner_id, version)`` for the item's owner, or None if the item does not exist."""
+    row = db.query(models.Item.owner_id, models.DataVersion.version).outerjoin(models.DataVersion, models.DataVersion.user_id == models.Item.owner_id).filter(models.Item.id == item_id).first()
+    if row is None:
+        return None
+    return row.owner_id, row.version or 0
+
+
 def create_item_for_user(db: Session, owner_id: int, title: str, category: str = "general", description: str = ""):
+    category = "general" if category is None else category
     item = models.Item(title=title, category=category, description=description, owner_id=owner_id)
     db.add(item)
+    db.flush()
+    search.index_item(db, item)
+    _bump_category_count(db, owner_id, category, 1)
+    bump_data_version(db, owner_id)
     db.commit()
     db.refresh(item)
+    events.item_changed("item.created", item, db)
     return item
 
 
-def list_items_for_user(db: Session, owner_id: int):
-    return db.query(models.Item).filter(models.Item.owner_id == owner_id).order_by(models.Item.created_at.desc()).all()
+def encode_cursor(row) -> str:
+    """Opaque keyset cursor for an item or comment row."""
+    raw = json.dumps([row.created_at.isoformat(), row.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Return the ``(created_at, id)`` pair for a cursor, or raise ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, item_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(item_id)
+    except Exception as exc:
+        raise ValueError("Invalid cursor") from exc
+
+
+def list_items_for_user(db: Session, owner_id: int, q: str = None, limit: int = None, offset: int = 0, cursor: str = None, ranked: bool = False):
+    """List an owner's items, newest first, or best match first if ``ranked``."""
+    query = db.query(models.Item).filter(models.Item.owner_id == owner_id)
+    rank = None
+    if q:
+        query, rank = search.apply_search(db, query, q)
+    if cursor:
+        created_at, item_id = decode_cursor(cursor)
+        # bind with the column type so SQLite compares like-formatted text
+        query = query.filter(tuple_(models.Item.created_at, models.Item.id) < tuple_(literal(created_at, models.Item.created_at.type), item_id))
+    order = [models.Item.created_at.desc(), models.Item.id.desc()]
+    if ranked and rank is not None:
+        order.insert(0, rank)
+    query = query.order_by(*order)
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def export_items_query(owner_id: int):
+    """Columns of every item an owner has, oldest first, for streaming out."""
+    item = models.Item
+    return select(item.id, item.title, item.category, item.description, item.file_path, item.created_at).where(item.owner_id == owner_id).order_by(item.created_at.asc(), item.id.asc())
 
 
 def stats_items_by_category(db: Session, owner_id: int):
-    from sqlalchemy import func
-    rows = db.query(models.Item.category, func.count(models.Item.id)).filter(models.Item.owner_id == owner_id).group_by(models.Item.category).all()
+    rows = db.query(models.CategoryCount.category, models.CategoryCount.count).filter(models.CategoryCount.owner_id == owner_id, models.CategoryCount.count > 0).all()
     return {row[0]: row[1] for row in rows}
 
 
+def _category_counts_from_items(db: Session, owner_id: int = None):
+    query = db.query(models.Item.owner_id, models.Item.category, func.count(models.Item.id)).filter(models.Item.category.isnot(None))
+    if owner_id is not None:
+        query = query.filter(models.Item.owner_id == owner_id)
+    return {(o, c): n for o, c, n in query.group_by(models.Item.owner_id, models.Item.category)}
+
+
+def verify_category_counts(db: Session, owner_id: int = None):
+    """Return ``{(owner_id, category): (stored, actual)}`` for every mismatch."""
+    actual = _category_counts_from_items(db, owner_id)
+    query = db.query(models.CategoryCount)
+    if owner_id is not None:
+        query = query.filter(models.CategoryCount.owner_id == owner_id)
+    stored = {(row.owner_id, row.category): row.count for row in query if row.count}
+    return {key: (stored.get(key, 0), actual.get(key, 0)) for key in stored.keys() | actual.keys() if stored.get(key, 0) != actual.get(key, 0)}
+
+
+def rebuild_category_counts(db: Session, owner_id: int = None):
+    """Recompute counters from the items table; returns the number of rows written."""
+    actual = _category_counts_from_items(db, owner_id)
+    query = db.query(models.CategoryCount)
+    if owner_id is not None:
+        query = query.filter(models.CategoryCount.owner_id == owner_id)
+    query.delete(synchronize_session=False)
+    db.add_all(models.CategoryCount(owner_id=o, category=c, count=n) for (o, c), n in actual.items())
+    db.commit()
+    return len(actual)
+
+
+def _locked_item(db: Session, item_id: int, owner_id: int):
+    # the row lock makes concurrent writers read the old category (and file) one at a
+    # time, so each counter change is applied once; SQLite serializes writers anyway
+    return db.query(models.Item).filter(models.Item.id == item_id, models.Item.owner_id == owner_id).with_for_update().first()
+
+
 def update_item(db: Session, item_id: int, owner_id: int, **fields):
-    item = db.query(models.Item).filter(models.Item.id == item_id, models.Item.owner_id == owner_id).first()
+    item = _locked_item(db, item_id, owner_id)
     if not item:
         return None
+    old_category = item.category
     for k, v in fields.items():
         if hasattr(item, k) and v is not None:
             setattr(item, k, v)
     db.add(item)
+    search.index_item(db, item)
+    if item.category != old_category:
+        if old_category is not None:
+            _bump_category_count(db, owner_id, old_category, -1)
+        _bump_category_count(db, owner_id, item.category, 1)
+    bump_data_version(db, owner_id)
     db.commit()
     db.refresh(item)
+    events.item_changed("item.updated", item, db)
     return item
 
 
 def delete_item(db: Session, item_id: int, owner_id: int):
-    item = db.query(models.Item).filter(models.Item.id == item_id, models.Item.owner_id == owner_id).first()
+    item = _locked_item(db, item_id, owner_id)
     if not item:
         return False
+    search.remove_item(db, item.id)
+    if item.category is not None:
+        _bump_category_count(db, owner_id, item.category, -1)
+    bump_data_version(db, owner_id)
+    file_path = item.file_path
     db.delete(item)
+    if file_path:
+        db.flush()
+        _release_blobs(db, [file_path])
     db.commit()
+    events.item_deleted(owner_id, item_id)
     return True
 
 
+def batch_items(db: Session, owner_id: int, creates=(), updates=(), deletes=()):
+    """Apply item creates, updates and deletes in one transaction.
+
+    ``creates`` are field dicts, ``updates`` field dicts with an ``id`` and
+    ``deletes`` item ids. Rows that cannot be applied (unknown id, repeated
+    id) are reported in ``errors`` and skipped; the rest commit together.
+    """
+    errors = []
+    category_deltas = Counter()
+
+    created = []
+    if creates:
+        rows = [{"title": c["title"], "category": "general" if c.get("category") is None else c["category"], "description": c.get("description") or "", "owner_id": owner_id} for c in creates]
+        created = db.scalars(insert(models.Item).returning(models.Item, sort_by_parameter_order=True), rows).all()
+        search.index_items(db, created)
+        category_deltas.update(item.category for item in created)
+
+    updated = []
+    if updates:
+        ids = [u["id"] for u in updates]
+        # locked in id order, so two batches over the same items can't deadlock
+        found = {item.id: item for item in db.query(models.Item).filter(models.Item.id.in_(ids), models.Item.owner_id == owner_id).order_by(models.Item.id).with_for_update()}
+        seen = set()
+        for index, fields in enumerate(updates):
+            item = found.get(fields["id"])
+            if item is None or fields["id"] in seen:
+                errors.append({"op": "update", "index": index, "id": fields["id"], "detail": "Item not found" if item is None else "Duplicate id in batch"})
+                continue
+            seen.add(item.id)
+            old_category = item.category
+            for k, v in fields.items():
+                if k != "id" and hasattr(item, k) and v is not None:
+                    setattr(item, k, v)
+            if item.category != old_category:
+                if old_category is not None:
+                    category_deltas[old_category] -= 1
+                category_deltas[item.category] += 1
+            updated.append(item)
+        db.flush()
+        search.index_items(db, updated)
+
+    deleted = []
+    if deletes:
+        found = {row.id: row for row in db.query(models.Item.id, models.Item.category, models.Item.file_path).filter(models.Item.id.in_(deletes), models.Item.owner_id == owner_id).order_by(models.Item.id).with_for_update()}
+        for index, item_id in enumerate(deletes):
+            if item_id not in found or item_id in deleted:
+                errors.append({"op": "delete", "index": index, "id": item_id, "detail": "Item not found" if item_id not in found else "Duplicate id in batch"})
+                continue
+            deleted.append(item_id)
+            if found[item_id].category is not None:
+                category_deltas[found[item_id].category] -= 1
+        if deleted:
+            # mirror the ORM's delete of a single item, which detaches its comments
+            db.execute(update(models.Comment).where(models.Comment.item_id.in_(deleted)).values(item_id=None))
+            db.execute(delete(models.Item).where(models.Item.id.in_(deleted)))
+            search.remove_items(db, deleted)
+            _release_blobs(db, {found[i].file_path for i in deleted if found[i].file_path})
+
+    for category, delta in category_deltas.items():
+        if delta:
+            _bump_category_count(db, owner_id, category, delta)
+    if created or updated or deleted:
+        bump_data_version(db, owner_id)
+    db.commit()
+    for item in created:
+        events.item_changed("item.created", item, db)
+    for item in updated:
+        events.item_changed("item.updated", item, db)
+    for item_id in deleted:
+        events.item_deleted(owner_id, item_id)
+    return {"created": created, "updated": updated, "deleted": deleted, "errors": errors}
+
+
 def get_user_by_id(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
 
+def get_item(db: Session, item_id: int):
+    return db.query(models.Item).filter(models.Item.id == item_id).first()
+
+
+def get_item_for_user(db: Session, item_id: int, owner_id: int):
+    return db.query(models.Item).filter(models.Item.id == item_id, models.Item.owner_id == owner_id).first()
+
+
 def set_item_file_path(db: Session, item_id: int, owner_id: int, path: str):
-    item = db.query(models.Item).filter(models.Item.id == item_id, models.Item.owner_id == owner_id).first()
+    item = _locked_item(db, item_id, owner_id)
     if not item:
         return None
-    item.file_path = path
+    old_path, item.file_path = item.file_path, path
     db.add(item)
+    _claim_blob(db, path)
+    if old_path and old_path != path:
+        db.flush()
+        _release_blobs(db, [old_path])
+    bump_data_version(db, owner_id)
     db.commit()
     db.refresh(item)
+    events.item_changed("item.updated", item, db)
     return item
 
 
+def register_blob(db: Session, path: str, size: int):
+    """Record a blob before its file is put in place.
+
+    A new or orphaned blob (re)starts its grace period, so the sweeper leaves
+    it alone until an item claims it; a referenced blob stays referenced.
+    """
+    table = models.Blob.__table__
+    now = datetime.now(timezone.utc)
+    dialect = db.bind.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert
+        stmt = insert(table).values(path=path, size=size, orphaned_at=now)
+        orphaned_at = case((table.c.orphaned_at.is_(None), None), else_=literal(now, table.c.orphaned_at.type))
+        db.execute(stmt.on_conflict_do_update(index_elements=[table.c.path], set_={"size": size, "orphaned_at": orphaned_at}))
+    else:
+        blob = db.get(models.Blob, path)
+        if blob is None:
+            db.add(models.Blob(path=path, size=size, orphaned_at=now))
+        elif blob.orphaned_at is not None:
+            blob.orphaned_at = now
+    db.commit()
+
+
+def _claim_blob(db: Session, path: str):
+    db.execute(update(models.Blob).where(models.Blob.path == path).values(orphaned_at=None))
+
+
+def _release_blobs(db: Session, paths):
+    """Mark blobs that no item references any more as orphaned; call after flushing the change."""
+    if not paths:
+        return
+    referenced = exists().where(models.Item.file_path == models.Blob.path)
+    db.execute(update(models.Blob).where(models.Blob.path.in_(list(paths)), models.Blob.orphaned_at.is_(None), ~referenced).values(orphaned_at=datetime.now(timezone.utc)).execution_options(synchronize_session=False))
+
+
+def orphaned_blobs(db: Session, before: datetime, limit: int):
+    return db.query(models.Blob).filter(models.Blob.orphaned_at.isnot(None), models.Blob.orphaned_at <= before).order_by(models.Blob.orphaned_at.asc()).limit(limit).all()
+
+
+def delete_orphaned_blob(db: Session, path: str, before: datetime) -> bool:
+    """Drop an orphaned blob's row and derivative job; False if it was claimed meanwhile."""
+    referenced = exists().where(models.Item.file_path == models.Blob.path)
+    result = db.execute(delete(models.Blob).where(models.Blob.path == path, models.Blob.orphaned_at.isnot(None), models.Blob.orphaned_at <= before, ~referenced))
+    if result.rowcount:
+        # a later upload of the same content must be able to queue variants again
+        db.execute(delete(models.DerivativeJob).where(models.DerivativeJob.source_path == path))
+    db.commit()
+    return bool(result.rowcount)
+
+
+def blob_exists(db: Session, path: str) -> bool:
+    return db.query(models.Blob.path).filter(models.Blob.path == path).first() is not None
+
+
+def storage_by_user(db: Session, limit: int = 100):
+    """Per-user blob count and bytes, largest first; a blob shared by two of a user's items counts once."""
+    refs = db.query(models.Item.owner_id, models.Blob.path, models.Blob.size).join(models.Blob, models.Blob.path == models.Item.file_path).distinct().subquery()
+    rows = (
+        db.query(models.User.id, models.User.username, func.count(refs.c.path), func.sum(refs.c.size))
+        .join(refs, refs.c.owner_id == models.User.id)
+        .group_by(models.User.id, models.User.username)
+        .order_by(func.sum(refs.c.size).desc())
+        .limit(limit)
+    )
+    return [{"user_id": uid, "username": name, "files": files, "bytes": int(size or 0)} for uid, name, files, size in rows]
+
+
+def storage_totals(db: Session) -> dict:
+    files, size = db.query(func.count(models.Blob.path), func.sum(models.Blob.size)).one()
+    orphaned, orphaned_size = db.query(func.count(models.Blob.path), func.sum(models.Blob.size)).filter(models.Blob.orphaned_at.isnot(None)).one()
+    return {"files": files, "bytes": int(size or 0), "orphaned_files": orphaned, "orphaned_bytes": int(orphaned_size or 0)}
+
+
 def create_comment(db: Session, user_id: int, item_id: int, content: str):
     comment = models.Comment(content=content, item_id=item_id, user_id=user_id)
     db.add(comment)
+    # comment counts and listings are versioned with the item's owner
+    owner_id = db.query(models.Item.owner_id).filter(models.Item.id == item_id).scalar()
+    if owner_id is not None:
+        bump_data_version(db, owner_id)
     db.commit()
     db.refresh(comment)
+    events.comment_created(comment, owner_id)
     return comment
 
 
-def list_comments_for_item(db: Session, item_id: int):
-    return db.query(models.Comment).filter(models.Comment.item_id == item_id).order_by(models.Comment.created_at.asc()).all()
+def list_comments_for_item(db: Session, item_id: int, limit: int = None, cursor: str = None):
+    """Comments oldest first; ``cursor`` continues after the row it was made from."""
+    query = db.query(models.Comment).filter(models.Comment.item_id == item_id)
+    if cursor:
+        created_at, comment_id = decode_cursor(cursor)
+        query = query.filter(tuple_(models.Comment.created_at, models.Comment.id) > tuple_(literal(created_at, models.Comment.created_at.type), comment_id))
+    query = query.order_by(models.Comment.created_at.asc(), models.Comment.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def comment_summaries(db: Session, item_ids, latest: int = 0):
+    """Return ``{item_id: (count, latest_comments)}`` for a page of items in one query.
+
+    ``latest_comments`` holds up to ``latest`` of the newest comments, oldest first.
+    Items without comments are absent from the result.
+    """
+    if not item_ids:
+        return {}
+    if latest <= 0:
+        rows = db.query(models.Comment.item_id, func.count(models.Comment.id)).filter(models.Comment.item_id.in_(item_ids)).group_by(models.Comment.item_id)
+        return {item_id: (count, []) for item_id, count in rows}
+    rank = func.row_number().over(partition_by=models.Comment.item_id, order_by=(models.Comment.created_at.desc(), models.Comment.id.desc()))
+    total = func.count().over(partition_by=models.Comment.item_id)
+    ranked = db.query(models.Comment, rank.label("rank"), total.label("total")).filter(models.Comment.item_id.in_(item_ids)).subquery()
+    comment = aliased(models.Comment, ranked)
+    rows = db.query(comment, ranked.c.total).filter(ranked.c.rank <= latest).order_by(ranked.c.item_id, ranked.c.rank.desc())
+    summaries = {}
+    for c, count in rows:
+        summaries.setdefault(c.item_id, (count, []))[1].append(c)
+    return summaries
 
 
 def list_all_users(db: Session):
@@ -104,4 +449,47 @@ def update_user_role(db: Session, user_id: int, role: str):
     db.add(user)
     db.commit()
     db.refresh(user)
+    principal_cache.invalidate(user.username)
     return user
+
+
+def create_audit(db: Session, actor: str, action: str, target: str = None, detail: str = None):
+    audit = models.Audit(actor=actor, action=action, target=target, detail=detail)
+    db.add(audit)
+    db.commit()
+    db.refresh(audit)
+    return audit
+
+
+def create_audits(db: Session, events):
+    """Bulk-insert audit event dicts in one transaction."""
+    if events:
+        db.execute(insert(models.Audit), list(events))
+        db.commit()
+
+
+def _prefix_filter(column, prefix: str):
+    # a range rather than LIKE so the comparison can use an index
+    return (column >= prefix) & (column < prefix + "\U0010ffff")
+
+
+def list_audits(db: Session, q: str = None, actor: str = None, action: str = None, limit: int = 50, offset: int = 0):
+    """Page of audit entries, newest first, with the total matching count.
+
+    ``actor``/``action`` match exactly; ``q`` matches a prefix of either.
+    """
+    query = db.query(models.Audit)
+    if actor:
+        query = query.filter(models.Audit.actor == actor)
+    if action:
+        query = query.filter(models.Audit.action == action)
+    if q:
+        # a UNION of two index ranges; an OR across the columns would scan the table
+        matching = union(
+            select(models.Audit.id).where(_prefix_filter(models.Audit.actor, q)),
+            select(models.Audit.id).where(_prefix_filter(models.Audit.action, q)),
+        ).subquery()
+        query = query.filter(models.Audit.id.in_(select(matching.c.id)))
+    total = query.with_entities(func.count(models.Audit.id)).scalar()
+    items = query.order_by(models.Audit.created_at.desc(), models.Audit.id.desc()).offset(offset).limit(limit).all()
+    return {"items": items, "total": total}
@@ -0,0 +1,73 @@
+"""Async counterparts of the ``crud`` functions used by event-loop handlers.
+
+Each one runs the sync implementation in ``crud`` on the AsyncSession's
+connection via ``run_sync``, so both paths share the same queries and
+side effects (search index, counters) while the handler never blocks a
+threadpool thread on the database.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    return await db.run_sync(crud.get_user_by_username, username)
+
+
+async def create_item_for_user(db: AsyncSession, owner_id: int, title: str, category: str = "general", description: str = ""):
+    return await db.run_sync(crud.create_item_for_user, owner_id, title, category, description)
+
+
+async def list_items_for_user(db: AsyncSession, owner_id: int, **kwargs):
+    return await db.run_sync(crud.list_items_for_user, owner_id, **kwargs)
+
+
+async def get_data_version(db: AsyncSession, user_id: int):
+    return await db.run_sync(crud.get_data_version, user_id)
+
+
+async def get_item_data_version(db: AsyncSession, item_id: int):
+    return await db.run_sync(crud.get_item_data_version, item_id)
+
+
+async def stats_items_by_category(db: AsyncSession, owner_id: int):
+    return await db.run_sync(crud.stats_items_by_category, owner_id)
+
+
+async def update_item(db: AsyncSession, item_id: int, owner_id: int, **fields):
+    return await db.run_sync(crud.update_item, item_id, owner_id, **fields)
+
+
+async def delete_item(db: AsyncSession, item_id: int, owner_id: int):
+    return await db.run_sync(crud.delete_item, item_id, owner_id)
+
+
+async def batch_items(db: AsyncSession, owner_id: int, creates=(), updates=(), deletes=()):
+    return await db.run_sync(crud.batch_items, owner_id, creates, updates, deletes)
+
+
+async def get_item(db: AsyncSession, item_id: int):
+    return await db.run_sync(crud.get_item, item_id)
+
+
+async def get_item_for_user(db: AsyncSession, item_id: int, owner_id: int):
+    return await db.run_sync(crud.get_item_for_user, item_id, owner_id)
+
+
+async def set_item_file_path(db: AsyncSession, item_id: int, owner_id: int, path: str):
+    return await db.run_sync(crud.set_item_file_path, item_id, owner_id, path)
+
+
+async def register_blob(db: AsyncSession, path: str, size: int):
+    return await db.run_sync(crud.register_blob, path, size)
+
+
+async def create_comment(db: AsyncSession, user_id: int, item_id: int, content: str):
+    return await db.run_sync(crud.create_comment, user_id, item_id, content)
+
+
+async def list_comments_for_item(db: AsyncSession, item_id: int, limit: int = None, cursor: str = None):
+    return await db.run_sync(crud.list_comments_for_item, item_id, limit, cursor)
+
+
+async def comment_summaries(db: AsyncSession, item_ids, latest: int = 0):
+    return await db.run_sync(crud.comment_summaries, item_ids, latest)
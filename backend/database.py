@@ -1,13 +1,242 @@
+import hashlib
 import os
-from sqlalchemy import create_engine
+import tempfile
+import threading
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./pt3.db")
+# optional replica for GET endpoints; SQLite defaults to a read-only pool on the same file
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 64 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+
+def engine_options(url: str) -> dict:
+    """create_engine keyword arguments for the URL's backend."""
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+
+
+def apply_sqlite_pragmas(sync_engine, readonly: bool = False):
+    """Tune every new SQLite connection; WAL lets readers run alongside a writer."""
+    if sync_engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            if not readonly:
+                cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+                cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            # negative cache_size is in KiB rather than pages
+            cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        finally:
+            cursor.close()
+
+
+def read_database_url(url: str = DATABASE_URL) -> str:
+    """URL for read-only sessions: the replica if configured, else the primary.
+
+    A file-backed SQLite primary gets its own pool of ``mode=ro`` connections.
+    """
+    if DATABASE_READ_URL:
+        return DATABASE_READ_URL
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database and parsed.database != ":memory:" and not parsed.database.startswith("file:"):
+        return parsed.set(database=f"file:{parsed.database}", query={**parsed.query, "mode": "ro", "uri": "true"}).render_as_string(hide_password=False)
+    return url
+
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+apply_sqlite_pragmas(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-def init_db():
-    from . import models
+_READ_URL = read_database_url()
+if _READ_URL == DATABASE_URL:
+    read_engine = engine
+else:
+    read_engine = create_engine(_READ_URL, **engine_options(_READ_URL))
+    apply_sqlite_pragmas(read_engine, readonly=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+_ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+_async_session_factories = {}
+_async_lock = threading.Lock()
+
+
+def async_database_url(url: str = DATABASE_URL) -> str:
+    """Map a sync URL to its asyncio driver (aiosqlite or asyncpg)."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return parsed.set(drivername=_ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+def get_async_session_factory(readonly: bool = False):
+    """Async engine and session factory, created on first use.
+
+    Lazy so that the sync-only users of this module (seed, scripts, tests)
+    don't need the async drivers installed. ``readonly`` routes to the same
+    target as ``ReadSessionLocal``.
+    """
+    url = _READ_URL if readonly else DATABASE_URL
+    with _async_lock:
+        if url not in _async_session_factories:
+            from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+            options = engine_options(url)
+            options.pop("connect_args", None)
+            async_engine = create_async_engine(async_database_url(url), **options)
+            apply_sqlite_pragmas(async_engine.sync_engine, readonly=url != DATABASE_URL)
+            # handlers read attributes after commit; reloading them would need IO
+            _async_session_factories[url] = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+        return _async_session_factories[url]
+
+
+async def dispose_async_engine():
+    with _async_lock:
+        factories = list(_async_session_factories.values())
+        _async_session_factories.clear()
+    for factory in factories:
+        await factory.kw["bind"].dispose()
+
+
+# Kept outside Base.metadata so the stamp can be read before the rest of the schema exists.
+_stamp_metadata = MetaData()
+schema_stamp = Table(
+    "schema_stamp", _stamp_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", String, nullable=False),
+)
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def schema_version() -> str:
+    """Fingerprint of the tables, columns and indexes the models declare."""
+    from . import models, search
+    parts = [search.SCHEMA_VERSION]
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name + ":" + ",".join(f"{c.name} {c.type!r}" for c in table.columns))
+        parts.extend(sorted(f"{index.name}({','.join(c.name for c in index.columns)})" for index in table.indexes))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+def _stored_version(conn):
+    try:
+        return conn.execute(select(schema_stamp.c.version).where(schema_stamp.c.id == 1)).scalar()
+    except (OperationalError, ProgrammingError):
+        # no stamp table yet; it is created under the init lock
+        return None
+
+
+def _create_stamp_table():
+    # IF NOT EXISTS as well as the lock, for platforms where the lock is a no-op
+    with engine.begin() as conn:
+        conn.execute(CreateTable(schema_stamp, if_not_exists=True))
+
+
+@contextmanager
+def _schema_init_lock():
+    """Serialize schema setup across processes: an advisory lock on PostgreSQL, a lock file elsewhere."""
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(hashtext('pt3_schema'))"))
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext('pt3_schema'))"))
+        return
+    try:
+        import fcntl
+    except ImportError:
+        # no flock (Windows): concurrent first starts fall back on the idempotent checkfirst DDL
+        yield
+        return
+    key = hashlib.sha256(DATABASE_URL.encode()).hexdigest()[:16]
+    with open(os.path.join(tempfile.gettempdir(), f"pt3-schema-{key}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def init_db() -> bool:
+    """Bring the schema up to date once; returns True if this call did the work.
+
+    Cheap when the stored stamp matches the models, so every worker can call
+    it on startup. The first process to find it stale does the DDL under a
+    lock while the others wait, then they see the new stamp and skip it.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return False
+    with _schema_lock:
+        if _schema_ready:
+            return False
+        version = schema_version()
+        with engine.connect() as conn:
+            current = _stored_version(conn) == version
+        if not current:
+            with _schema_init_lock():
+                _create_stamp_table()
+                with engine.connect() as conn:
+                    current = _stored_version(conn) == version
+                if not current:
+                    _create_schema()
+                    with engine.begin() as conn:
+                        conn.execute(schema_stamp.delete())
+                        conn.execute(schema_stamp.insert().values(id=1, version=version))
+        _schema_ready = True
+        return not current
+
+
+def invalidate_schema_stamp():
+    """Make the next ``init_db`` redo the DDL, e.g. after dropping indexes for a bulk load."""
+    global _schema_ready
+    with _schema_lock, _schema_init_lock():
+        _create_stamp_table()
+        with engine.begin() as conn:
+            conn.execute(schema_stamp.delete())
+        _schema_ready = False
+
+
+def _create_schema():
+    from . import models, search
     Base.metadata.create_all(bind=engine)
+    # create_all skips existing tables, so add any indexes introduced since
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    search.init_search(engine)
+    _backfill_category_counts()
+
+
+def _backfill_category_counts():
+    # the counters table starts empty on databases that predate it
+    from . import models, crud
+    db = SessionLocal()
+    try:
+        if db.query(models.CategoryCount).first() is None and db.query(models.Item.id).first() is not None:
+            crud.rebuild_category_counts(db)
+    finally:
+        db.close()
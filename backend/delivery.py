@@ -0,0 +1,182 @@
+"""File delivery for uploads and the frontend.
+
+Uploads never change once written: content-addressed blobs and their
+variants are named by hash, and legacy names carry an item id and a
+timestamp. They are served with a strong ETag, a year-long immutable
+Cache-Control, single-range requests and, where the ASGI server offers the
+``http.response.zerocopysend`` extension, zero-copy sendfile.
+
+Frontend assets are small and fixed for the life of the process, so they
+are read once, precompressed with gzip (and brotli when the optional
+``brotli`` package is installed) and served from memory.
+
+``data_etag`` tags API responses with the owner's data version (see
+``crud.bump_data_version``), so unchanged refreshes get a 304.
+"""
+import gzip
+import hashlib
+import os
+import re
+import threading
+from email.utils import formatdate
+from typing import Optional
+import anyio
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+FRONTEND_DIR = os.path.join(os.path.dirname(__file__), "..", "frontend")
+IMMUTABLE = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 64 * 1024
+_CONTENT_ADDRESSED = re.compile(r"([0-9a-f]{64})(\.[a-z0-9]+)*")
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in header.split(",")]
+
+
+def data_etag(version: int, *parts) -> str:
+    """ETag for an API response that only changes when ``version`` does.
+
+    ``parts`` identify the representation (user, query string), so different
+    pages or users never share a tag.
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+    return f'"v{version}-{digest}"'
+
+
+class BlobResponse(Response):
+    """Serve a file from disk, honouring If-None-Match and a single Range."""
+
+    def __init__(self, path: str, stat: os.stat_result, etag: str, request: Request, media_type: Optional[str] = None):
+        self.path = path
+        self.size = stat.st_size
+        self.offset, self.length = 0, stat.st_size
+        self.send_body = request.method != "HEAD"
+        headers = {
+            "etag": etag,
+            "cache-control": IMMUTABLE,
+            "last-modified": formatdate(stat.st_mtime, usegmt=True),
+            "accept-ranges": "bytes",
+        }
+        status_code = 200
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            status_code, self.length, self.send_body = 304, 0, False
+        elif "range" in request.headers and request.headers.get("if-range", etag) == etag:
+            status_code = self._apply_range(request.headers["range"], headers)
+        if status_code != 304:
+            headers["content-length"] = str(self.length)
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type if status_code in (200, 206) else None)
+        if status_code == 416:
+            self.send_body = False
+
+    def _apply_range(self, header: str, headers: dict) -> int:
+        match = _RANGE.fullmatch(header.strip())
+        if not match or match.groups() == ("", ""):
+            # multi-range or malformed: a full 200 is a valid answer
+            return 200
+        start, end = match.groups()
+        if start == "":
+            start, end = max(0, self.size - int(end)), self.size - 1
+        else:
+            start, end = int(start), min(int(end), self.size - 1) if end else self.size - 1
+        if start >= self.size or start > end:
+            headers["content-range"] = f"bytes */{self.size}"
+            self.length = 0
+            return 416
+        self.offset, self.length = start, end - start + 1
+        headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+        return 206
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f.wrapped.fileno(), "offset": self.offset, "count": self.length, "more_body": False})
+                return
+            await f.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining:
+                await send({"type": "http.response.body", "body": b""})
+
+
+def upload_etag(name: str, stat: os.stat_result) -> str:
+    match = _CONTENT_ADDRESSED.fullmatch(name)
+    if match:
+        suffix = name[64:]
+        return f'"{match.group(1)}{suffix}"'
+    return '"%s"' % hashlib.sha256(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:32]
+
+
+class Asset:
+    def __init__(self, body: bytes, media_type: str):
+        self.media_type = media_type
+        self.encodings = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(body)
+        # a strong ETag names one exact body, so each encoding gets its own
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"' for encoding in self.encodings}
+
+
+_MEDIA_TYPES = {".html": "text/html", ".js": "application/javascript", ".css": "text/css"}
+_assets: Optional[dict] = None
+_assets_lock = threading.Lock()
+
+
+def _load_assets() -> dict:
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            assets = {}
+            for name in os.listdir(FRONTEND_DIR):
+                path = os.path.join(FRONTEND_DIR, name)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        assets[name] = Asset(f.read(), _MEDIA_TYPES.get(os.path.splitext(name)[1], "application/octet-stream"))
+            _assets = assets
+        return _assets
+
+
+def _accepted(header: str) -> set:
+    accepted = set()
+    for part in header.split(","):
+        token, _, params = part.strip().partition(";")
+        if token and not re.search(r"q=0(\.0*)?\s*$", params):
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def asset_response(name: str, request: Request, cache_control: str) -> Optional[Response]:
+    asset = _load_assets().get(name)
+    if asset is None:
+        return None
+    accepted = _accepted(request.headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in asset.encodings and e in accepted), "identity")
+    headers = {"etag": asset.etags[encoding], "cache-control": cache_control, "vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), asset.etags[encoding]):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["content-encoding"] = encoding
+    body = asset.encodings[encoding] if request.method != "HEAD" else b""
+    response = Response(body, headers=headers, media_type=asset.media_type)
+    if request.method == "HEAD":
+        response.headers["content-length"] = str(len(asset.encodings[encoding]))
+    return response
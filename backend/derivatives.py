@@ -0,0 +1,135 @@
+"""Background thumbnail and medium-size variants for uploaded images.
+
+``enqueue`` records a ``DerivativeJob`` row for an uploaded image and hands
+it to a small thread pool, so the upload response never waits on resizing.
+Job rows persist the pipeline state: ``resume`` resubmits anything left
+pending, interrupted or retryable after a restart. Variants are written
+next to the source blob and renamed into place before the job is marked
+done, so a done job means its variants are ready to serve.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import crud, database, models
+
+VARIANTS = {"thumb": 200, "medium": 800}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", 2))
+MAX_ATTEMPTS = 3
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(DERIVATIVE_WORKERS, thread_name_prefix="derivatives")
+        return _executor
+
+
+def variant_path(source_path: str, variant: str) -> str:
+    stem = os.path.splitext(source_path)[0]
+    return f"{stem}.{variant}.jpg"
+
+
+def is_image(source_path: Optional[str]) -> bool:
+    return bool(source_path) and os.path.splitext(source_path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def variant_urls(source_path: Optional[str], ready: bool = False) -> dict:
+    """Map ``<variant>_url`` to its URL, or None while it is not ready.
+
+    ``ready`` comes from the job row (see ``ready_sources``), not the
+    filesystem, so serializing a page of items makes no stat calls.
+    """
+    ready = ready and is_image(source_path)
+    return {f"{variant}_url": f"/uploads/{os.path.basename(variant_path(source_path, variant))}" if ready else None for variant in VARIANTS}
+
+
+def ready_sources(db: Session, paths) -> set:
+    """The image paths among ``paths`` whose variants are rendered; one query per page."""
+    paths = {path for path in paths if is_image(path)}
+    if not paths:
+        return set()
+    rows = db.query(models.DerivativeJob.source_path).filter(models.DerivativeJob.source_path.in_(paths), models.DerivativeJob.status == "done")
+    return {path for (path,) in rows}
+
+
+def enqueue(db: Session, source_path: str):
+    """Queue variants for ``source_path`` if it is an image not seen before."""
+    if not is_image(source_path):
+        return None
+    job = models.DerivativeJob(source_path=source_path)
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # content-addressed blobs are shared; the first upload owns the job
+        db.rollback()
+        return None
+    _get_executor().submit(_process, job.id)
+    return job
+
+
+def resume():
+    """Resubmit jobs that were pending, interrupted, or failed with retries left."""
+    db = database.SessionLocal()
+    try:
+        jobs = db.query(models.DerivativeJob.id).filter(or_(
+            models.DerivativeJob.status.in_(("pending", "running")),
+            (models.DerivativeJob.status == "failed") & (models.DerivativeJob.attempts < MAX_ATTEMPTS),
+        )).all()
+    finally:
+        db.close()
+    for (job_id,) in jobs:
+        _get_executor().submit(_process, job_id)
+    return len(jobs)
+
+
+def _render(source_path: str):
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as im:
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        for variant, size in VARIANTS.items():
+            out = im.copy()
+            out.thumbnail((size, size))
+            dest = variant_path(source_path, variant)
+            tmp = dest + ".tmp"
+            out.save(tmp, "JPEG", quality=82, optimize=True)
+            os.replace(tmp, dest)
+
+
+def _process(job_id: int):
+    db = database.SessionLocal()
+    try:
+        job = db.get(models.DerivativeJob, job_id)
+        if job is None or job.status == "done":
+            return
+        job.status = "running"
+        job.attempts += 1
+        db.commit()
+        try:
+            _render(job.source_path)
+            job.status, job.error = "done", None
+            # new variant URLs change the owners' item listings
+            for (owner_id,) in db.query(models.Item.owner_id).filter(models.Item.file_path == job.source_path).distinct():
+                crud.bump_data_version(db, owner_id)
+        except Exception as exc:
+            job.status, job.error = "failed", str(exc)[:500]
+        db.commit()
+    finally:
+        db.close()
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,195 @@
+"""In-process change feed for items and comments.
+
+The write paths in ``crud`` publish an event after each commit: item
+changes go to the owner's ``user`` topic, and new comments go to the
+item's ``item`` topic and to its owner. ``GET /api/events`` streams them
+to subscribers as Server-Sent Events.
+
+Each subscriber has a bounded queue. A subscriber that falls behind far
+enough to fill it gets a final ``overflow`` event and is disconnected, so
+it can re-sync with a normal GET and reconnect; publishers never wait on a
+slow client. An idle subscriber is only a queue and a parked task, so
+thousands fit in one worker. Streams also end after
+``EVENTS_MAX_STREAM_SECONDS`` so that connections rebalance across workers
+and don't hold up a graceful shutdown.
+
+The hub only sees writes made in its own process. With several workers, a
+subscriber gets the writes handled by the worker it is connected to.
+"""
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, Optional
+import orjson
+
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", 256))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 10000))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", 15))
+EVENTS_MAX_STREAM_SECONDS = float(os.getenv("EVENTS_MAX_STREAM_SECONDS", 300))
+MAX_ITEM_TOPICS = 100
+
+_OVERFLOW = {"type": "overflow", "data": None}
+
+
+class Subscription:
+    def __init__(self, topics, maxsize: int):
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+
+    def offer(self, event: dict) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            # make room for the overflow marker; everything queued is stale anyway
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(_OVERFLOW)
+            self.closed = True
+            return False
+
+
+class Hub:
+    def __init__(self, queue_size: int, max_subscribers: int):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._topics = defaultdict(set)
+        self._count = 0
+        self._loop = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def full(self) -> bool:
+        return self._count >= self.max_subscribers
+
+    def subscribe(self, user_id: int, item_ids: Iterable[int] = ()) -> Subscription:
+        """Register a subscriber; call from the event loop that will read it."""
+        topics = {("user", user_id)} | {("item", item_id) for item_id in item_ids}
+        sub = Subscription(topics, self.queue_size)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            for topic in topics:
+                self._topics[topic].add(sub)
+            self._count += 1
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._topics.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._topics[topic]
+            self._count -= 1
+            if not self._count:
+                self._loop = None
+        sub.closed = True
+
+    def has_subscribers(self, topics) -> bool:
+        # unlocked read: a subscriber that races in only misses this one event
+        return any(topic in self._topics for topic in topics)
+
+    def publish(self, topics, event_type: str, data):
+        """Queue an event for subscribers of any of ``topics``; safe from any thread."""
+        loop = self._loop
+        if loop is None:
+            return
+        with self._lock:
+            event = {"id": next(self._ids), "type": event_type, "data": data}
+            self.published += 1
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(topics, event)
+            return
+        try:
+            loop.call_soon_threadsafe(self._dispatch, topics, event)
+        except RuntimeError:
+            # the loop closed under us; nobody is left to read it
+            pass
+
+    def _dispatch(self, topics, event: dict):
+        with self._lock:
+            subs = set().union(*(self._topics.get(topic, ()) for topic in topics))
+        for sub in subs:
+            if sub.offer(event):
+                self.delivered += 1
+            else:
+                self.dropped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"subscribers": self._count, "topics": len(self._topics), "published": self.published, "delivered": self.delivered, "dropped": self.dropped}
+
+
+hub = Hub(EVENTS_QUEUE_SIZE, EVENTS_MAX_SUBSCRIBERS)
+
+
+def _format(event: dict) -> bytes:
+    head = f"id: {event['id']}\n" if "id" in event else ""
+    return f"{head}event: {event['type']}\ndata: ".encode() + orjson.dumps(event["data"]) + b"\n\n"
+
+
+async def stream(user_id: int, item_ids: Iterable[int] = (), max_seconds: Optional[float] = None):
+    """Subscribe and yield SSE frames until overflow, timeout or disconnect."""
+    sub = hub.subscribe(user_id, item_ids)
+    deadline = time.monotonic() + (EVENTS_MAX_STREAM_SECONDS if max_seconds is None else max_seconds)
+    try:
+        # tell EventSource to reconnect quickly once the stream ends
+        yield b"retry: 2000\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = await asyncio.wait_for(sub.queue.get(), min(EVENTS_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            yield _format(event)
+            if event is _OVERFLOW:
+                return
+    finally:
+        hub.unsubscribe(sub)
+
+
+# the helpers below are called by crud after commit; they skip building the
+# payload when nobody is subscribed to the topics involved
+
+def item_changed(event_type: str, item, db=None):
+    topics = [("user", item.owner_id)]
+    if hub.has_subscribers(topics):
+        from . import derivatives, serialization
+        ready = derivatives.ready_sources(db, [item.file_path]) if db is not None else frozenset()
+        hub.publish(topics, event_type, serialization.item_row(item, ready))
+
+
+def item_deleted(owner_id: int, item_id: int):
+    topics = [("user", owner_id)]
+    if hub.has_subscribers(topics):
+        hub.publish(topics, "item.deleted", {"id": item_id})
+
+
+def comment_created(comment, owner_id: Optional[int]):
+    topics = [("item", comment.item_id)] + ([("user", owner_id)] if owner_id is not None else [])
+    if hub.has_subscribers(topics):
+        from . import serialization
+        hub.publish(topics, "comment.created", serialization.comment_row(comment))
+
+
+def import_progress(owner_id: int, imported: int, failed: int):
+    topics = [("user", owner_id)]
+    if hub.has_subscribers(topics):
+        hub.publish(topics, "import.progress", {"imported": imported, "failed": failed})
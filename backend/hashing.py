@@ -0,0 +1,86 @@
+"""Password hashing on a dedicated process pool.
+
+pbkdf2 is deliberately CPU-heavy; running it on the request threadpool holds
+the GIL and starves every other endpoint during a login burst. The async
+helpers here hand the work to a small process pool instead. Submissions are
+bounded: once ``PASSWORD_HASH_MAX_PENDING`` jobs are queued or running,
+further calls raise ``HashPoolSaturated`` so the caller can answer 503.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", 29000))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", max(1, PASSWORD_HASH_WORKERS) * 8))
+
+# min/max pin the cost, so hashes made with any other round count are
+# reported as needing an update and get rehashed on the next login.
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=PASSWORD_HASH_ROUNDS,
+    pbkdf2_sha256__min_rounds=PASSWORD_HASH_ROUNDS,
+    pbkdf2_sha256__max_rounds=PASSWORD_HASH_ROUNDS,
+)
+
+
+class HashPoolSaturated(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork: workers only need this module, not a
+            # copy of a multi-threaded server process
+            _pool = ProcessPoolExecutor(PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+async def _submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashPoolSaturated()
+    try:
+        if PASSWORD_HASH_WORKERS <= 0:
+            future = asyncio.get_running_loop().run_in_executor(None, fn, *args)
+        else:
+            future = asyncio.wrap_future(_get_pool().submit(fn, *args))
+        return await future
+    finally:
+        _slots.release()
+
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """Return ``(ok, new_hash)``; ``new_hash`` is set when the stored hash is outdated."""
+    return await _submit(_verify_and_update, password, hashed)
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
@@ -1,91 +1,216 @@
+import mimetypes
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, Query, Path, status, UploadFile, File
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Depends, HTTPException, Query, Path, Request, Response, status, UploadFile, File
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
 
-from . import database, models, schemas, crud, auth
+from . import database, models, schemas, crud, crud_async, auth, audit, events, hashing, storage, derivatives, delivery, metrics, ratelimit, serialization, sweeper, transfer
 
 load_dotenv()
 
-app = FastAPI(title="PT-3 Fullstack Demo")
+# set to 0 on all but one worker so only one resumes derivative jobs and sweeps storage
+RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "1") != "0"
 
+
+def startup():
+    # importing this module does no I/O; the schema check, directories and
+    # background workers start here, once per process
+    database.init_db()
+    os.makedirs(storage.UPLOAD_DIR, exist_ok=True)
+    if RUN_BACKGROUND_JOBS:
+        derivatives.resume()
+        sweeper.sweeper.start()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(startup)
+    try:
+        yield
+    finally:
+        hashing.shutdown()
+        sweeper.sweeper.shutdown()
+        derivatives.shutdown()
+        audit.writer.shutdown()
+        await database.dispose_async_engine()
+
+
+app = FastAPI(title="PT-3 Fullstack Demo", lifespan=lifespan)
+
+# innermost: sheds login/upload bursts before the body is read; CORS still applies to its 429/503s
+app.add_middleware(ratelimit.AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+# outermost, so the recorded latency includes the other middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@app.api_route("/", methods=["GET", "HEAD"], response_class=HTMLResponse)
+def index(request: Request):
+    return delivery.asset_response("index.html", request, "no-cache")
+
+
+@app.api_route("/static/{name}", methods=["GET", "HEAD"])
+def static_asset(name: str, request: Request):
+    response = delivery.asset_response(name, request, "public, max-age=3600")
+    if response is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return response
 
-database.init_db()
 
-app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "frontend")), name="static")
 # Serve uploaded files
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "..", "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+@app.api_route("/uploads/{name}", methods=["GET", "HEAD"])
+def uploaded_file(name: str, request: Request):
+    # temp files from in-progress writes start with "." or end with ".tmp"
+    if name.startswith(".") or name.endswith(".tmp") or os.path.basename(name) != name:
+        raise HTTPException(status_code=404, detail="Not Found")
+    path = os.path.join(storage.UPLOAD_DIR, name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return delivery.BlobResponse(path, stat, delivery.upload_etag(name, stat), request, media_type=mimetypes.guess_type(name)[0] or "application/octet-stream")
+
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def prometheus_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    path = os.path.join(os.path.dirname(__file__), "..", "frontend", "index.html")
-    with open(path, "r", encoding="utf-8") as f:
-        return HTMLResponse(f.read())
 
+@app.exception_handler(hashing.HashPoolSaturated)
+def hash_pool_saturated(request, exc):
+    return JSONResponse(status_code=503, content={"detail": "Server busy, retry shortly"}, headers={"Retry-After": "1"})
 
+
+# register and login run on the event loop so pbkdf2 waits on the hashing
+# pool instead of holding a threadpool slot; DB calls still use the threadpool
 @app.post("/api/register", response_model=schemas.UserOut)
-def register(user_in: schemas.UserCreate, db: Session = Depends(auth.get_db)):
-    existing = crud.get_user_by_username(db, user_in.username)
+async def register(user_in: schemas.UserCreate, db: Session = Depends(auth.get_db)):
+    existing = await run_in_threadpool(crud.get_user_by_username, db, user_in.username)
     if existing:
         raise HTTPException(status_code=400, detail="Username already taken")
-    user = crud.create_user(db, user_in.username, user_in.password)
+    hashed = await hashing.hash_password(user_in.password)
+    user = await run_in_threadpool(crud.create_user, db, user_in.username, hashed_password=hashed)
     return user
 
 
 @app.post("/api/login")
-def login(user_in: schemas.UserCreate, db: Session = Depends(auth.get_db)):
-    user = crud.authenticate_user(db, user_in.username, user_in.password)
+async def login(user_in: schemas.UserCreate, db: Session = Depends(auth.get_db)):
+    await ratelimit.check_account(user_in.username)
+    user = await run_in_threadpool(crud.get_user_by_username, db, user_in.username)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
+    ok, new_hash = await hashing.verify_password(user_in.password, user.hashed_password)
+    if not ok:
+        raise HTTPException(status_code=400, detail="Incorrect username or password")
+    if new_hash:
+        # stored hash predates the configured cost; upgrade it transparently
+        await run_in_threadpool(crud.set_user_password_hash, db, user.id, new_hash)
     access_token = auth.create_access_token({"sub": user.username})
     refresh_token = auth.create_refresh_token({"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
 
 
+def _versioned(request: Request, version: int, *parts):
+    """Cache headers for a response tagged with a data version, plus a 304 if the client's copy is current."""
+    etag = delivery.data_etag(version, *parts, request.url.query)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if delivery.etag_matches(request.headers.get("if-none-match"), etag):
+        return headers, Response(status_code=304, headers=headers)
+    return headers, None
+
+
+# item endpoints return ORJSONResponse built by serialization, which skips
+# response_model validation; response_model still documents the shape
 @app.get("/api/items", response_model=list[schemas.ItemOut])
-def list_items(q: Optional[str] = Query(None, description="search query for title"), limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    items = crud.list_items_for_user(db, current_user.id)
-    if q:
-        items = [it for it in items if q.lower() in (it.title or "").lower()]
-    return items[offset: offset + limit]
+async def list_items(request: Request, q: Optional[str] = Query(None, description="full-text search over title, description and category"), sort: Optional[str] = Query(None, regex="^(relevance|recent)$", description="defaults to relevance when q is given"), limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0), cursor: Optional[str] = Query(None, description="opaque cursor from X-Next-Cursor"), comment_counts: bool = Query(False, description="embed comment_count per item"), latest_comments: int = Query(0, ge=0, le=20, description="embed up to N newest comments per item"), fmt: str = Query("rows", alias="format", regex="^(rows|columns)$", description="columns returns one array per field"), current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_read_db)):
+    ranked = bool(q) and (sort or "relevance") == "relevance"
+    if cursor and offset:
+        raise HTTPException(status_code=400, detail="Use either cursor or offset, not both")
+    if cursor and ranked:
+        raise HTTPException(status_code=400, detail="Cursors require sort=recent")
+    # read the version before the rows, so a concurrent write can only make the tag stale, never wrong
+    headers, not_modified = _versioned(request, await crud_async.get_data_version(db, current_user.id), "items", current_user.id)
+    if not_modified:
+        return not_modified
+    try:
+        items = await crud_async.list_items_for_user(db, current_user.id, q=q, limit=limit, offset=offset, cursor=cursor, ranked=ranked)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # a full page means there may be more; hand back a keyset cursor for it
+    if len(items) == limit and not ranked:
+        headers["X-Next-Cursor"] = crud.encode_cursor(items[-1])
+    ready = await db.run_sync(derivatives.ready_sources, [it.file_path for it in items])
+    out = [serialization.item_row(it, ready) for it in items]
+    fields = serialization.ITEM_FIELDS
+    if comment_counts or latest_comments:
+        summaries = await crud_async.comment_summaries(db, [it.id for it in items], latest_comments)
+        fields += ("comment_count", "latest_comments") if latest_comments else ("comment_count",)
+        for row in out:
+            count, latest = summaries.get(row["id"], (0, []))
+            row["comment_count"] = count
+            if latest_comments:
+                row["latest_comments"] = [serialization.comment_row(c) for c in latest]
+    if fmt == "columns":
+        return ORJSONResponse(serialization.item_columns(out, fields), headers=headers)
+    return ORJSONResponse(out, headers=headers)
 
 
 @app.post("/api/items", response_model=schemas.ItemOut)
-def add_item(item: schemas.ItemCreate, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    it = crud.create_item_for_user(db, current_user.id, item.title, item.category, item.description)
-    # attach file_url if present
-    file_url = None
-    if it.file_path:
-        file_url = f"/uploads/{os.path.basename(it.file_path)}"
-    return {**schemas.ItemOut.from_orm(it).dict(), "file_url": file_url}
+async def add_item(item: schemas.ItemCreate, current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    it = await crud_async.create_item_for_user(db, current_user.id, item.title, item.category, item.description)
+    return ORJSONResponse(serialization.item_row(it))
+
+
+@app.post("/api/items/batch", response_model=schemas.ItemBatchResult)
+async def batch_items(batch: schemas.ItemBatch, current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    result = await crud_async.batch_items(db, current_user.id, creates=[c.dict() for c in batch.create], updates=[u.dict() for u in batch.update], deletes=batch.delete)
+    ready = await db.run_sync(derivatives.ready_sources, [it.file_path for it in result["updated"]])
+    return ORJSONResponse({**result, "created": [serialization.item_row(it) for it in result["created"]], "updated": [serialization.item_row(it, ready) for it in result["updated"]]})
+
+
+@app.get("/api/items/export")
+async def export_items(fmt: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"), current_user: auth.Principal = Depends(auth.get_current_user_async)):
+    headers = {"Content-Disposition": f'attachment; filename="items.{fmt}"'}
+    return StreamingResponse(transfer.export_items(current_user.id, fmt), media_type=transfer.MEDIA_TYPES[fmt], headers=headers)
+
+
+@app.post("/api/items/import")
+async def import_items(request: Request, fmt: Optional[str] = Query(None, alias="format", regex="^(ndjson|csv)$", description="defaults from Content-Type"), current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    if fmt is None:
+        fmt = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+    return await transfer.import_items(db, current_user.id, request.stream(), fmt)
 
 
 @app.put("/api/items/{item_id}", response_model=schemas.ItemOut)
-def update_item(item_id: int = Path(..., ge=1), item: schemas.ItemCreate = None, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    updated = crud.update_item(db, item_id, current_user.id, title=item.title if item else None, category=item.category if item else None, description=item.description if item else None)
+async def update_item(item_id: int = Path(..., ge=1), item: schemas.ItemCreate = None, current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    updated = await crud_async.update_item(db, item_id, current_user.id, title=item.title if item else None, category=item.category if item else None, description=item.description if item else None)
     if not updated:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
-    file_url = f"/uploads/{os.path.basename(updated.file_path)}" if updated.file_path else None
-    return {**schemas.ItemOut.from_orm(updated).dict(), "file_url": file_url}
+    return ORJSONResponse(serialization.item_row(updated, await db.run_sync(derivatives.ready_sources, [updated.file_path])))
 
 
 @app.delete("/api/items/{item_id}")
-def delete_item(item_id: int = Path(..., ge=1), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    ok = crud.delete_item(db, item_id, current_user.id)
+async def delete_item(item_id: int = Path(..., ge=1), current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    ok = await crud_async.delete_item(db, item_id, current_user.id)
     if not ok:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
     return {"ok": True}
@@ -93,46 +218,74 @@ def delete_item(item_id: int = Path(..., ge=1), current_user: models.User = Depe
 
 
 @app.post("/api/items/{item_id}/upload-multipart", response_model=schemas.ItemOut)
-async def upload_multipart(item_id: int, file: UploadFile = File(...), current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    # save file to uploads dir
-    filename = f"{item_id}_{int(__import__('time').time())}_{file.filename}"
-    dest = os.path.join(UPLOAD_DIR, filename)
-    import aiofiles
-    async with aiofiles.open(dest, 'wb') as out:
-        content = await file.read()
-        await out.write(content)
-    updated = crud.set_item_file_path(db, item_id, current_user.id, dest)
+async def upload_multipart(item_id: int, file: UploadFile = File(...), current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
+    owned = await crud_async.get_item_for_user(db, item_id, current_user.id)
+    if not owned:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
+    try:
+        dest = await storage.save_upload(file, register=lambda path, size: crud_async.register_blob(db, path, size))
+    except storage.UploadTooLarge:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"File exceeds {storage.MAX_UPLOAD_BYTES} bytes")
+    updated = await crud_async.set_item_file_path(db, item_id, current_user.id, dest)
     if not updated:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
-    file_url = f"/uploads/{os.path.basename(dest)}"
-    return {**schemas.ItemOut.from_orm(updated).dict(), "file_url": file_url}
+    # serialize first: enqueue may roll back, which expires the item; identical content may already have variants
+    out = serialization.item_row(updated, await db.run_sync(derivatives.ready_sources, [dest]))
+    # variants render in the background; their URLs appear once ready
+    await db.run_sync(derivatives.enqueue, dest)
+    return ORJSONResponse(out)
 
 
 @app.post("/api/items/{item_id}/comments", response_model=schemas.CommentOut)
-def add_comment(item_id: int, payload: schemas.CommentCreate, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
+async def add_comment(item_id: int, payload: schemas.CommentCreate, current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_db)):
     # ensure item exists
-    it = db.query(models.Item).filter(models.Item.id == item_id).first()
+    it = await crud_async.get_item(db, item_id)
     if not it:
         raise HTTPException(status_code=404, detail="Item not found")
-    c = crud.create_comment(db, current_user.id, item_id, payload.content)
+    c = await crud_async.create_comment(db, current_user.id, item_id, payload.content)
     return c
 
 
 @app.get("/api/items/{item_id}/comments", response_model=list[schemas.CommentOut])
-def list_comments(item_id: int, db: Session = Depends(auth.get_db)):
-    return crud.list_comments_for_item(db, item_id)
+async def list_comments(request: Request, item_id: int, limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = Query(None, description="opaque cursor from X-Next-Cursor"), db: AsyncSession = Depends(auth.get_async_read_db)):
+    headers = {}
+    owner_version = await crud_async.get_item_data_version(db, item_id)
+    if owner_version is not None:
+        owner_id, version = owner_version
+        headers, not_modified = _versioned(request, version, "comments", owner_id, item_id)
+        if not_modified:
+            return not_modified
+    try:
+        comments = await crud_async.list_comments_for_item(db, item_id, limit=limit, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if len(comments) == limit:
+        headers["X-Next-Cursor"] = crud.encode_cursor(comments[-1])
+    return ORJSONResponse([serialization.comment_row(c) for c in comments], headers=headers)
+
+
+@app.get("/api/events")
+async def change_feed(item_id: List[int] = Query([], description="also receive new comments on these items"), current_user: auth.Principal = Depends(auth.get_stream_user)):
+    """Server-Sent Events for the caller's items and comments, and comments on ``item_id``."""
+    if len(item_id) > events.MAX_ITEM_TOPICS:
+        raise HTTPException(status_code=400, detail=f"At most {events.MAX_ITEM_TOPICS} item_id values")
+    if events.hub.full():
+        raise HTTPException(status_code=503, detail="Too many subscribers", headers={"Retry-After": "5"})
+    # the stream holds no DB session, so idle subscribers cost only a queue
+    return StreamingResponse(events.stream(current_user.id, item_id), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/api/admin/users", response_model=list[schemas.UserOut])
-def admin_list_users(admin_user: models.User = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_db)):
+def admin_list_users(admin_user: auth.Principal = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_read_db)):
     return crud.list_all_users(db)
 
 
 @app.put("/api/admin/users/{user_id}", response_model=schemas.UserOut)
-def admin_update_user(user_id: int, payload: schemas.UserUpdate, admin_user: models.User = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_db)):
+def admin_update_user(user_id: int, payload: schemas.UserUpdate, admin_user: auth.Principal = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_db)):
     user = crud.get_user_by_id(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    old_username = user.username
     updated = user
     if payload.role:
         updated = crud.update_user_role(db, user_id, payload.role)
@@ -141,24 +294,44 @@ def admin_update_user(user_id: int, payload: schemas.UserUpdate, admin_user: mod
         db.add(updated)
         db.commit()
         db.refresh(updated)
-    # record audit
-    try:
-        crud.create_audit(db, actor=admin_user.username, action='update_user', target=str(user_id), detail=f'role={payload.role}')
-    except Exception:
-        pass
+        auth.principal_cache.invalidate(old_username)
+    # buffered; written in batches off the request path
+    audit.record(actor=admin_user.username, action='update_user', target=str(user_id), detail=f'role={payload.role}')
     return updated
 
 
-@app.get("/api/admin/audit")
-def admin_list_audit(q: Optional[str] = Query(None), limit: int = Query(50, ge=1, le=500), offset: int = Query(0, ge=0), admin_user: models.User = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_db)):
-    result = crud.list_audits(db, q=q, limit=limit, offset=offset)
-    # convert ORM objects to dicts via schemas
-    items = [schemas.AuditOut.from_orm(a).dict() for a in result['items']]
-    return {"items": items, "total": result['total']}
+@app.get("/api/admin/audit", response_model=schemas.AuditPage)
+def admin_list_audit(q: Optional[str] = Query(None, description="prefix of actor or action"), actor: Optional[str] = Query(None), action: Optional[str] = Query(None), limit: int = Query(50, ge=1, le=500), offset: int = Query(0, ge=0), admin_user: auth.Principal = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_read_db)):
+    return crud.list_audits(db, q=q, actor=actor, action=action, limit=limit, offset=offset)
+
+
+@app.get("/api/admin/audit/stats")
+def admin_audit_writer_stats(admin_user: auth.Principal = Depends(auth.require_role('admin'))):
+    return audit.writer.stats()
+
+
+@app.get("/api/admin/events")
+def admin_event_stats(admin_user: auth.Principal = Depends(auth.require_role('admin'))):
+    return events.hub.stats()
+
+
+@app.get("/api/admin/rate-limits")
+def admin_rate_limit_stats(admin_user: auth.Principal = Depends(auth.require_role('admin'))):
+    return ratelimit.limiter.stats()
+
+
+@app.get("/api/admin/storage")
+def admin_storage_stats(limit: int = Query(100, ge=1, le=1000), admin_user: auth.Principal = Depends(auth.require_role('admin')), db: Session = Depends(auth.get_read_db)):
+    return {"totals": crud.storage_totals(db), "users": crud.storage_by_user(db, limit), "sweeper": sweeper.sweeper.stats()}
+
+
+@app.get("/api/admin/auth-cache")
+def admin_auth_cache_stats(admin_user: auth.Principal = Depends(auth.require_role('admin'))):
+    return auth.principal_cache.stats()
 
 
 @app.get("/api/me", response_model=schemas.UserOut)
-def me(current_user: models.User = Depends(auth.get_current_user)):
+def me(current_user: auth.Principal = Depends(auth.get_current_user)):
     return current_user
 
 
@@ -179,5 +352,8 @@ def refresh_token(refresh: dict):
 
 
 @app.get("/api/stats")
-def stats(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(auth.get_db)):
-    return crud.stats_items_by_category(db, current_user.id)
+async def stats(request: Request, current_user: auth.Principal = Depends(auth.get_current_user_async), db: AsyncSession = Depends(auth.get_async_read_db)):
+    headers, not_modified = _versioned(request, await crud_async.get_data_version(db, current_user.id), "stats", current_user.id)
+    if not_modified:
+        return not_modified
+    return ORJSONResponse(await crud_async.stats_items_by_category(db, current_user.id), headers=headers)
@@ -0,0 +1,210 @@
+"""Request and database metrics in the Prometheus text format.
+
+``MetricsMiddleware`` times every HTTP request and labels it with the route
+template rather than the raw path, so ``/api/items/{item_id}`` is one series.
+SQLAlchemy cursor events count queries and DB time against the request that
+issued them, whether it ran on the event loop, in the threadpool or through
+an AsyncSession. Each response carries a ``Server-Timing`` header, and
+``render`` produces the ``/metrics`` page. Metrics are per process.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+class _RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# holds a mutable object, so DB calls made from copied contexts (threadpool,
+# run_sync greenlets) still add to the request that started them
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+
+    def lines(self, name: str, labels: str):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.total}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.in_progress = 0
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries_per_request = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+        self.db_queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.slow_queries = 0
+        self.background_queries = 0
+
+    def observe(self, method: str, route: str, status: int, seconds: float, stats: _RequestStats):
+        with self.lock:
+            self.requests[(method, route, status)] += 1
+            self.latency[(method, route)].observe(seconds)
+            self.queries_per_request[(method, route)].observe(stats.queries)
+            self.db_queries[(method, route)] += stats.queries
+            self.db_seconds[(method, route)] += stats.db_seconds
+
+    def clear(self):
+        with self.lock:
+            self._reset()
+
+
+registry = Registry()
+# callables returning extra exposition lines, for subsystems with their own counters
+collectors = []
+
+
+def _labels(method: str, route: str) -> str:
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return f'method="{method}",route="{route}"'
+
+
+def render() -> str:
+    """The current metrics as Prometheus text exposition."""
+    r = registry
+    out = []
+    with r.lock:
+        out += ["# HELP http_requests_in_progress Requests currently being served.", "# TYPE http_requests_in_progress gauge", f"http_requests_in_progress {r.in_progress}"]
+        out += ["# HELP http_requests_total Completed requests.", "# TYPE http_requests_total counter"]
+        for (method, route, status), n in sorted(r.requests.items()):
+            out.append(f'http_requests_total{{{_labels(method, route)},status="{status}"}} {n}')
+        out += ["# HELP http_request_duration_seconds Request latency.", "# TYPE http_request_duration_seconds histogram"]
+        for key, hist in sorted(r.latency.items()):
+            out += hist.lines("http_request_duration_seconds", _labels(*key))
+        out += ["# HELP http_request_db_queries SQL statements issued per request.", "# TYPE http_request_db_queries histogram"]
+        for key, hist in sorted(r.queries_per_request.items()):
+            out += hist.lines("http_request_db_queries", _labels(*key))
+        out += ["# HELP db_queries_total SQL statements issued by requests.", "# TYPE db_queries_total counter"]
+        for key, n in sorted(r.db_queries.items()):
+            out.append(f"db_queries_total{{{_labels(*key)}}} {n}")
+        out += ["# HELP db_query_seconds_total Time spent in SQL statements by requests.", "# TYPE db_query_seconds_total counter"]
+        for key, seconds in sorted(r.db_seconds.items()):
+            out.append(f"db_query_seconds_total{{{_labels(*key)}}} {seconds}")
+        out += ["# HELP db_background_queries_total SQL statements issued outside requests.", "# TYPE db_background_queries_total counter", f"db_background_queries_total {r.background_queries}"]
+        out += [f"# HELP db_slow_queries_total SQL statements slower than {SLOW_QUERY_MS}ms.", "# TYPE db_slow_queries_total counter", f"db_slow_queries_total {r.slow_queries}"]
+    for collector in collectors:
+        out += collector()
+    return "\n".join(out) + "\n"
+
+
+# registered on the Engine class so the lazily created async engines are covered too
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+    else:
+        with registry.lock:
+            registry.background_queries += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        with registry.lock:
+            registry.slow_queries += 1
+        logger.warning("Slow query (%.1fms): %s", elapsed * 1000, statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and DB work per route."""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    def _route_template(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        router = scope.get("router")
+        if endpoint is None or router is None:
+            # unmatched paths share one series to keep label cardinality bounded
+            return "<unmatched>"
+        if endpoint not in self._routes:
+            for route in router.routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    self._routes[endpoint] = route.path
+                    break
+            else:
+                return "<unmatched>"
+        return self._routes[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = _RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                app_ms = (time.perf_counter() - start) * 1000
+                timing = f'app;dur={app_ms:.1f}, db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"'
+                message["headers"] = [*message.get("headers", []), (b"server-timing", timing.encode("latin-1"))]
+            await send(message)
+
+        with registry.lock:
+            registry.in_progress += 1
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            with registry.lock:
+                registry.in_progress -= 1
+            _current.reset(token)
+            registry.observe(scope["method"], self._route_template(scope), status, time.perf_counter() - start, stats)
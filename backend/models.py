@@ -1,7 +1,16 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index, func
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# SQLite stores datetimes as text and CURRENT_TIMESTAMP has second precision.
+# Values bound through this type use the same format (microseconds are
+# dropped), so comparisons against server-generated values order correctly.
+Timestamp = DateTime(timezone=True).with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 
 class User(Base):
     __tablename__ = "users"
@@ -21,10 +30,17 @@ class Item(Base):
     description = Column(String, default="")
     file_path = Column(String, nullable=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(Timestamp, server_default=func.now())
     owner = relationship("User", back_populates="items")
     comments = relationship("Comment", back_populates="item")
 
+    __table_args__ = (
+        # keyset pagination for GET /api/items walks this index newest-first
+        Index("ix_items_owner_created_id", "owner_id", "created_at", "id"),
+        # finding the items that reference an uploaded blob
+        Index("ix_items_file_path", "file_path"),
+    )
+
 
 class Comment(Base):
     __tablename__ = "comments"
@@ -32,10 +48,15 @@ class Comment(Base):
     content = Column(String, nullable=False)
     item_id = Column(Integer, ForeignKey("items.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(Timestamp, server_default=func.now())
     item = relationship("Item", back_populates="comments")
     author = relationship("User", back_populates="comments")
 
+    __table_args__ = (
+        # per-item comment pages and the latest-N embed on GET /api/items
+        Index("ix_comments_item_created_id", "item_id", "created_at", "id"),
+    )
+
 
 class Audit(Base):
     __tablename__ = "audits"
@@ -44,4 +65,47 @@ class Audit(Base):
     action = Column(String, nullable=False)
     target = Column(String, nullable=True)
     detail = Column(String, nullable=True)
+    created_at = Column(Timestamp, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_audits_created_at", "created_at"),
+        Index("ix_audits_actor_action", "actor", "action"),
+        # lets the action half of a ``q`` search be its own index range
+        Index("ix_audits_action", "action"),
+    )
+
+
+class DerivativeJob(Base):
+    __tablename__ = "derivative_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    source_path = Column(String, unique=True, nullable=False)
+    status = Column(String, index=True, default="pending", nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    error = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class CategoryCount(Base):
+    """Per-owner item count by category, maintained by the item write paths."""
+    __tablename__ = "category_counts"
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    category = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class Blob(Base):
+    """An uploaded file in the blob store; items reference it through ``Item.file_path``."""
+    __tablename__ = "blobs"
+    path = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    created_at = Column(Timestamp, server_default=func.now())
+    # set while no item references the blob; the sweeper deletes it after a grace period
+    orphaned_at = Column(Timestamp, nullable=True, index=True)
+
+
+class DataVersion(Base):
+    """Per-user counter bumped by every write that changes the user's items or their comments."""
+    __tablename__ = "data_versions"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,337 @@
+"""Admission control for the expensive endpoints.
+
+``AdmissionMiddleware`` runs before routing and before the request body is
+read, so rejected traffic costs almost nothing. For each route class
+(login, upload) it applies, in order:
+
+- a token bucket per client IP,
+- a token bucket per authenticated user (the JWT subject), and
+- a cap on requests of that class in flight in this process.
+
+Upload requests are also held to ``MAX_UPLOAD_BYTES`` (plus multipart
+framing) before the body is spooled: a larger ``Content-Length`` gets 413
+straight away, and a body that keeps going past the limit fails with 413
+as soon as it crosses it.
+
+A request over a bucket gets 429 with ``Retry-After``; one over the
+concurrency cap gets 503. ``check_account`` adds a per-username bucket
+that ``/api/login`` applies once it has parsed the body, which slows
+credential stuffing against one account from many IPs.
+
+Buckets live in a store with ``take`` and ``reset``. ``MemoryBucketStore`` is per process.
+``SQLiteBucketStore`` keeps them in a local SQLite file that every worker
+on the host shares, a stand-in for a shared store such as Redis with the
+same ``take`` contract. Its calls block, so they run on the threadpool, and
+when the file is locked for too long the request is charged to a
+per-process bucket instead of being let through. Rates are ``"<requests>/<seconds>"`` strings, and
+the request count is also the burst size.
+"""
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Optional
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from . import auth, metrics, storage
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+# trusted proxies in front of the app; the client is the entry the outermost one appended
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", 1))
+LOGIN_IP_RATE = os.getenv("LOGIN_IP_RATE", "30/60")
+LOGIN_ACCOUNT_RATE = os.getenv("LOGIN_ACCOUNT_RATE", "10/60")
+LOGIN_CONCURRENCY = int(os.getenv("LOGIN_CONCURRENCY", 64))
+UPLOAD_IP_RATE = os.getenv("UPLOAD_IP_RATE", "120/60")
+UPLOAD_USER_RATE = os.getenv("UPLOAD_USER_RATE", "60/60")
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 16))
+# room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class Rate:
+    def __init__(self, spec: str):
+        count, seconds = spec.split("/")
+        self.burst = float(count)
+        self.per_second = float(count) / float(seconds)
+
+
+class MemoryBucketStore:
+    """Token buckets in a bounded LRU; the least recently used keys are forgotten first."""
+
+    blocking = False
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: Rate, cost: float = 1.0) -> float:
+        """Spend ``cost`` tokens; returns 0 if allowed, else seconds until it would be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rate.burst, now))
+            tokens = min(rate.burst, tokens + (now - updated) * rate.per_second)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0.0 if allowed else (cost - tokens) / rate.per_second
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file shared by the workers on one host."""
+
+    blocking = True
+
+    def __init__(self, path: str, busy_timeout: float = 0.05):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.fallbacks = 0
+        self._fallback = MemoryBucketStore()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # opened on first use in each thread, so importing this module touches no files
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rate: Rate, cost: float = 1.0) -> float:
+        # wall clock, since the monotonic clock isn't shared between processes
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # store busy: still limit, per process, rather than letting a burst through
+            self.fallbacks += 1
+            return self._fallback.take(key, rate, cost)
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (rate.burst, now)
+            tokens = min(rate.burst, tokens + max(0.0, now - updated) * rate.per_second)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute("INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return 0.0 if allowed else (cost - tokens) / rate.per_second
+
+    def reset(self):
+        self._connect().execute("DELETE FROM buckets")
+        self._fallback.reset()
+
+
+def make_store(spec: str):
+    if spec == "memory":
+        return MemoryBucketStore()
+    if spec.startswith("sqlite:///"):
+        return SQLiteBucketStore(spec[len("sqlite:///"):])
+    raise ValueError(f"Unknown RATE_LIMIT_STORE {spec!r}")
+
+
+class RouteClass:
+    def __init__(self, name: str, ip_rate: Optional[str], user_rate: Optional[str], concurrency: int, max_body: Optional[Callable[[], int]] = None):
+        self.name = name
+        self.ip_rate = Rate(ip_rate) if ip_rate else None
+        self.user_rate = Rate(user_rate) if user_rate else None
+        self.concurrency = concurrency
+        # returns the largest request body accepted, read per request so it follows the current setting
+        self.max_body = max_body
+        self.in_flight = 0
+
+
+class Limiter:
+    def __init__(self, store, enabled: bool = True):
+        self.store = store
+        self.enabled = enabled
+        self.classes = {}
+        self.rules = []
+        self.account_rate = Rate(LOGIN_ACCOUNT_RATE)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_rule(self, method: str, path_pattern: str, route_class: RouteClass):
+        self.classes[route_class.name] = route_class
+        self.rules.append((method, re.compile(path_pattern), route_class))
+
+    def match(self, method: str, path: str) -> Optional[RouteClass]:
+        for rule_method, pattern, route_class in self.rules:
+            if method == rule_method and pattern.fullmatch(path):
+                return route_class
+        return None
+
+    def count(self, route_class: str, outcome: str):
+        with self._lock:
+            self.counters[(route_class, outcome)] += 1
+
+    def reset(self):
+        self.store.reset()
+        with self._lock:
+            self.counters.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            name: {"in_flight": rc.in_flight, "concurrency": rc.concurrency, **{outcome: n for (c, outcome), n in counters.items() if c == name}}
+            for name, rc in self.classes.items()
+        }
+
+
+def _metric_lines():
+    lines = ["# HELP admission_requests_total Requests to rate-limited routes by outcome.", "# TYPE admission_requests_total counter"]
+    with limiter._lock:
+        counters = sorted(limiter.counters.items())
+    lines += [f'admission_requests_total{{route_class="{name}",outcome="{outcome}"}} {n}' for (name, outcome), n in counters]
+    lines += ["# HELP admission_in_flight Requests of a route class being served.", "# TYPE admission_in_flight gauge"]
+    lines += [f'admission_in_flight{{route_class="{name}"}} {rc.in_flight}' for name, rc in limiter.classes.items()]
+    lines += ["# HELP admission_store_fallbacks_total Checks charged to a per-process bucket because the shared store was busy.", "# TYPE admission_store_fallbacks_total counter"]
+    lines.append(f"admission_store_fallbacks_total {getattr(limiter.store, 'fallbacks', 0)}")
+    return lines
+
+
+limiter = Limiter(make_store(RATE_LIMIT_STORE), RATE_LIMIT_ENABLED)
+limiter.add_rule("POST", r"/api/login", RouteClass("login", LOGIN_IP_RATE, None, LOGIN_CONCURRENCY))
+limiter.add_rule("POST", r"/api/items/\d+/upload-multipart", RouteClass("upload", UPLOAD_IP_RATE, UPLOAD_USER_RATE, UPLOAD_CONCURRENCY, max_body=lambda: storage.MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES))
+metrics.collectors.append(_metric_lines)
+
+
+def _too_many(retry_after: float, detail: str, status_code: int = 429) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=status_code, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+async def _take(store, key: str, rate: Rate) -> float:
+    if store.blocking:
+        return await run_in_threadpool(store.take, key, rate)
+    return store.take(key, rate)
+
+
+async def check_account(username: str):
+    """Per-username login bucket; raises 429 once an account is being hammered."""
+    if not limiter.enabled:
+        return
+    wait = await _take(limiter.store, f"login:account:{username.lower()}", limiter.account_rate)
+    if wait:
+        limiter.count("login", "rejected_account")
+        raise HTTPException(status_code=429, detail="Too many login attempts for this account", headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+
+def _client_ip(scope) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        # the client can send any X-Forwarded-For it likes; only the entries our
+        # own proxies appended, counted from the right, can be trusted
+        hops = [hop.strip() for name, value in scope["headers"] if name == b"x-forwarded-for" for hop in value.decode("latin-1").split(",")]
+        hops = [hop for hop in hops if hop]
+        if hops:
+            return hops[max(0, len(hops) - RATE_LIMIT_PROXY_HOPS)]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _bearer_subject(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            return auth.token_subject(token) if scheme.lower() == "bearer" else None
+    return None
+
+
+def _content_length(scope) -> Optional[int]:
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _limit_body(receive, limit: int):
+    """Wrap ``receive`` to fail with 413 once more than ``limit`` body bytes arrive.
+
+    The route sees the error while it parses the body, before the rest is
+    spooled; FastAPI passes HTTPException through its body parsing as is.
+    """
+    received = 0
+
+    async def limited():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(status_code=413, detail=f"Request body exceeds {limit} bytes")
+        return message
+
+    return limited
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, limiter: Limiter = limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        route_class = self.limiter.match(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+        name = route_class.name
+        if route_class.max_body is not None:
+            # size limits apply even with rate limiting turned off
+            limit = route_class.max_body()
+            length = _content_length(scope)
+            if length is not None and length > limit:
+                self.limiter.count(name, "rejected_size")
+                await JSONResponse({"detail": f"Request body exceeds {limit} bytes"}, status_code=413)(scope, receive, send)
+                return
+            receive = _limit_body(receive, limit)
+        if not self.limiter.enabled:
+            await self.app(scope, receive, send)
+            return
+        store = self.limiter.store
+        if route_class.ip_rate:
+            wait = await _take(store, f"{name}:ip:{_client_ip(scope)}", route_class.ip_rate)
+            if wait:
+                self.limiter.count(name, "rejected_ip")
+                await _too_many(wait, "Too many requests")(scope, receive, send)
+                return
+        if route_class.user_rate:
+            subject = _bearer_subject(scope)
+            wait = await _take(store, f"{name}:user:{subject}", route_class.user_rate) if subject else 0
+            if wait:
+                self.limiter.count(name, "rejected_user")
+                await _too_many(wait, "Too many requests")(scope, receive, send)
+                return
+        # single event loop per process, so no lock is needed around in_flight
+        if route_class.in_flight >= route_class.concurrency:
+            self.limiter.count(name, "shed_concurrency")
+            await _too_many(1, "Server busy, retry shortly", status_code=503)(scope, receive, send)
+            return
+        route_class.in_flight += 1
+        self.limiter.count(name, "admitted")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.in_flight -= 1
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
 from typing import Optional, List
 from datetime import datetime
 
@@ -44,11 +44,39 @@ class ItemOut(BaseModel):
     owner_id: int
     created_at: datetime
     file_url: Optional[str] = None
+    thumb_url: Optional[str] = None
+    medium_url: Optional[str] = None
+    comment_count: Optional[int] = None
+    latest_comments: Optional[List["CommentOut"]] = None
 
     class Config:
         orm_mode = True
 
 
+class ItemBatchUpdate(ItemUpdate):
+    id: int
+
+
+class ItemBatch(BaseModel):
+    create: conlist(ItemCreate, max_items=1000) = []
+    update: conlist(ItemBatchUpdate, max_items=1000) = []
+    delete: conlist(int, max_items=1000) = []
+
+
+class ItemBatchError(BaseModel):
+    op: str
+    index: int
+    id: Optional[int]
+    detail: str
+
+
+class ItemBatchResult(BaseModel):
+    created: List[ItemOut]
+    updated: List[ItemOut]
+    deleted: List[int]
+    errors: List[ItemBatchError]
+
+
 class CommentCreate(BaseModel):
     content: str
 
@@ -64,6 +92,9 @@ class CommentOut(BaseModel):
         orm_mode = True
 
 
+ItemOut.update_forward_refs(CommentOut=CommentOut)
+
+
 class AuditOut(BaseModel):
     id: int
     actor: str
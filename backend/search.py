@@ -0,0 +1,92 @@
+"""Full-text search over item title, description and category.
+
+SQLite uses an FTS5 table (``items_fts``) kept in sync by the write paths in
+``crud.py``. Postgres uses a GIN index over a tsvector expression, which the
+database maintains itself. Other engines fall back to a substring match.
+"""
+import re
+from sqlalchemy import Integer, column, func, literal_column, or_, table, text
+from sqlalchemy.orm import Query, Session
+from . import models
+
+FTS_TABLE = "items_fts"
+_PG_DOCUMENT = "to_tsvector('simple', coalesce(items.title, '') || ' ' || coalesce(items.description, '') || ' ' || coalesce(items.category, ''))"
+
+# part of database.schema_version(); bump when init_search creates something new
+SCHEMA_VERSION = "1"
+
+_fts = table(FTS_TABLE, column("rowid", Integer), column("rank"))
+
+
+def init_search(engine):
+    """Create the search index for the engine's dialect, backfilling if new."""
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :n"), {"n": FTS_TABLE}).first()
+            if exists:
+                return
+            conn.execute(text(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(title, description, category)"))
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}(rowid, title, description, category) SELECT id, title, description, category FROM items"))
+        elif engine.dialect.name == "postgresql":
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_items_fts ON items USING gin ({_PG_DOCUMENT})"))
+
+
+def _terms(q: str):
+    return re.findall(r"\w+", q.lower())
+
+
+def index_item(db: Session, item: models.Item):
+    """(Re)index an item; call after flush so ``item.id`` is set."""
+    index_items(db, [item])
+
+
+def index_items(db: Session, items):
+    if db.bind.dialect.name != "sqlite" or not items:
+        return
+    remove_items(db, [item.id for item in items])
+    db.execute(
+        text(f"INSERT INTO {FTS_TABLE}(rowid, title, description, category) VALUES (:id, :title, :description, :category)"),
+        [{"id": item.id, "title": item.title or "", "description": item.description or "", "category": item.category or ""} for item in items],
+    )
+
+
+def index_range(conn, first_id: int, last_id: int):
+    """Index items with ids in ``[first_id, last_id]``, for bulk loads that bypass the ORM."""
+    if conn.dialect.name != "sqlite":
+        return
+    conn.execute(
+        text(f"INSERT INTO {FTS_TABLE}(rowid, title, description, category) SELECT id, title, description, category FROM items WHERE id BETWEEN :lo AND :hi"),
+        {"lo": first_id, "hi": last_id},
+    )
+
+
+def remove_item(db: Session, item_id: int):
+    remove_items(db, [item_id])
+
+
+def remove_items(db: Session, item_ids):
+    if db.bind.dialect.name != "sqlite" or not item_ids:
+        return
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), [{"id": item_id} for item_id in item_ids])
+
+
+def apply_search(db: Session, query: Query, q: str):
+    """Restrict ``query`` to items matching ``q``.
+
+    Every term must match, as a prefix. Returns the filtered query and an
+    expression to order by for best-first results (None if not ranked).
+    """
+    terms = _terms(q)
+    dialect = db.bind.dialect.name
+    if terms and dialect == "sqlite":
+        match = " ".join(f'"{t}"*' for t in terms)
+        query = query.join(_fts, _fts.c.rowid == models.Item.id).filter(literal_column(FTS_TABLE).op("MATCH")(match))
+        # FTS5 rank is bm25, where lower is better
+        return query, _fts.c.rank.asc()
+    if terms and dialect == "postgresql":
+        document = literal_column(_PG_DOCUMENT)
+        tsquery = func.to_tsquery("simple", " & ".join(f"{t}:*" for t in terms))
+        query = query.filter(document.op("@@")(tsquery))
+        return query, func.ts_rank(document, tsquery).desc()
+    fields = (models.Item.title, models.Item.description, models.Item.category)
+    return query.filter(or_(*(f.icontains(q, autoescape=True) for f in fields))), None
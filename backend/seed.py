@@ -1,11 +1,35 @@
-"""Seed script to create a demo user and sample items."""
-from . import database, crud
+"""Seed script to create a demo user and sample items.
 
-# ensure database tables exist
-database.init_db()
+Usage:
+    python -m backend.seed
+    python -m backend.seed --bulk --users 100000 --items-per-user 20 --comments-per-item 2 --workers 4
+
+``--bulk`` generates synthetic users, items and comments for profiling at
+production volume. Rows are written with multi-row INSERTs in large
+batches, and the data depends only on ``--seed``, not on ``--workers``.
+Item counts per user are log-normal, categories and words are Zipf
+distributed, and description lengths are log-normal, so indexes and
+queries see realistic skew.
+"""
+import argparse
+import math
+import multiprocessing
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from sqlalchemy import create_engine, event, func, insert, text
+from . import auth, database, crud, models, search
+
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+SPAN_SECONDS = 3 * 365 * 24 * 3600
+CATEGORIES = ["general", "work", "personal", "finance", "travel", "photos", "recipes", "music", "books", "health",
+              "projects", "receipts", "kids", "garden", "cars", "home", "school", "sports", "pets", "archive"]
+BULK_PASSWORD = "bulkpass"
 
 
 def run():
+    database.init_db()
     db = database.SessionLocal()
     try:
         user = crud.get_user_by_username(db, "demo")
@@ -31,5 +55,185 @@ def run():
         db.close()
 
 
+def _zipf_cum_weights(n: int, s: float = 1.1):
+    return list(accumulate(1 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def _vocabulary(seed: int, size: int = 5000):
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ne", "ra", "to", "vi", "su", "pe", "da", "ri", "on", "el", "an", "ex", "or"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    # Zipf weights follow list order, so don't let the most common words be alphabetical
+    rng.shuffle(words)
+    return words
+
+
+def _lognormal_int(rng: random.Random, mean: float, sigma: float = 1.0) -> int:
+    if mean <= 0:
+        return 0
+    return int(rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma))
+
+
+def _item_counts(seed: int, users: int, items_per_user: float):
+    rng = random.Random(f"{seed}:counts")
+    return [_lognormal_int(rng, items_per_user) for _ in range(users)]
+
+
+def _bulk_engine():
+    """A private engine for the load, so relaxed durability never reaches the shared pool."""
+    engine = create_engine(database.DATABASE_URL, **database.engine_options(database.DATABASE_URL))
+    database.apply_sqlite_pragmas(engine)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _no_fsync(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA synchronous=OFF")
+    return engine
+
+
+def _load_shard(task):
+    """Generate and insert the items and comments of one contiguous range of users."""
+    seed, first, counts, user_base, item_base, total_users, comments_per_item, batch_size = task
+    engine = _bulk_engine()
+    try:
+        return _generate_shard(engine, seed, first, counts, user_base, item_base, total_users, comments_per_item, batch_size)
+    finally:
+        engine.dispose()
+
+
+def _generate_shard(engine, seed, first, counts, user_base, item_base, total_users, comments_per_item, batch_size):
+    vocab = _vocabulary(seed)
+    word_weights = _zipf_cum_weights(len(vocab))
+    category_weights = _zipf_cum_weights(len(CATEGORIES))
+    items_table, comments_table = models.Item.__table__, models.Comment.__table__
+    items, comments = [], []
+    written = [0, 0]
+
+    def flush():
+        if not items and not comments:
+            return
+        with engine.begin() as conn:
+            if items:
+                conn.execute(insert(items_table), items)
+                search.index_range(conn, items[0]["id"], items[-1]["id"])
+            if comments:
+                conn.execute(insert(comments_table), comments)
+        written[0] += len(items)
+        written[1] += len(comments)
+        items.clear()
+        comments.clear()
+
+    item_id = item_base
+    for offset, count in enumerate(counts):
+        index = first + offset
+        # one generator per user keeps the output independent of sharding
+        rng = random.Random(seed * 1_000_003 + index)
+        owner_id = user_base + index + 1
+        for _ in range(count):
+            item_id += 1
+            created_at = EPOCH - timedelta(seconds=rng.randrange(SPAN_SECONDS))
+            items.append({
+                "id": item_id,
+                "title": " ".join(rng.choices(vocab, cum_weights=word_weights, k=rng.randint(2, 8))),
+                "category": rng.choices(CATEGORIES, cum_weights=category_weights)[0],
+                "description": " ".join(rng.choices(vocab, cum_weights=word_weights, k=min(400, _lognormal_int(rng, 25)))),
+                "owner_id": owner_id,
+                "created_at": created_at,
+            })
+            # geometric with the requested mean: many items get none, a few get many
+            for _ in range(int(rng.expovariate(math.log1p(1 / comments_per_item))) if comments_per_item > 0 else 0):
+                comments.append({
+                    "content": " ".join(rng.choices(vocab, cum_weights=word_weights, k=rng.randint(3, 40))),
+                    "item_id": item_id,
+                    "user_id": user_base + rng.randrange(total_users) + 1,
+                    "created_at": created_at + timedelta(seconds=rng.randrange(30 * 24 * 3600)),
+                })
+            if len(items) >= batch_size or len(comments) >= batch_size:
+                flush()
+    flush()
+    return tuple(written)
+
+
+def bulk(users: int, items_per_user: float, comments_per_item: float, seed: int = 1, workers: int = 1, batch_size: int = 10000, defer_indexes: bool = False):
+    """Insert synthetic data; returns ``(users, items, comments)`` written."""
+    database.init_db()
+    start = time.monotonic()
+    with database.engine.connect() as conn:
+        if conn.execute(text("SELECT 1 FROM users WHERE username = :u"), {"u": f"bulk{seed}_0"}).first():
+            raise SystemExit(f"Seed {seed} was already loaded; pick another --seed")
+        user_base = conn.execute(func.coalesce(func.max(models.User.id), 0).select()).scalar()
+        item_base = conn.execute(func.coalesce(func.max(models.Item.id), 0).select()).scalar()
+
+    secondary = [index for table in (models.Item.__table__, models.Comment.__table__) for index in table.indexes]
+    if defer_indexes:
+        # a load that dies half way leaves the indexes missing; have the next startup recreate them
+        database.invalidate_schema_stamp()
+        # maintaining secondary indexes row by row is the bulk of the load time
+        for index in secondary:
+            index.drop(bind=database.engine, checkfirst=True)
+
+    hashed = auth.get_password_hash(BULK_PASSWORD)
+    for lo in range(0, users, batch_size):
+        rows = [{"id": user_base + i + 1, "username": f"bulk{seed}_{i}", "hashed_password": hashed, "role": "user"} for i in range(lo, min(users, lo + batch_size))]
+        with database.engine.begin() as conn:
+            conn.execute(insert(models.User.__table__), rows)
+
+    counts = _item_counts(seed, users, items_per_user)
+    shard_size = max(1, math.ceil(users / max(1, workers * 4)))
+    tasks, first_item = [], item_base
+    for lo in range(0, users, shard_size):
+        shard = counts[lo:lo + shard_size]
+        tasks.append((seed, lo, shard, user_base, first_item, users, comments_per_item, batch_size))
+        first_item += sum(shard)
+
+    totals = [0, 0]
+    if workers > 1:
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            results = pool.imap_unordered(_load_shard, tasks)
+            for done, (n_items, n_comments) in enumerate(results, 1):
+                totals[0] += n_items
+                totals[1] += n_comments
+                print(f"  shard {done}/{len(tasks)}: {totals[0]} items, {totals[1]} comments")
+    else:
+        for done, task in enumerate(tasks, 1):
+            n_items, n_comments = _load_shard(task)
+            totals[0] += n_items
+            totals[1] += n_comments
+            print(f"  shard {done}/{len(tasks)}: {totals[0]} items, {totals[1]} comments")
+
+    if defer_indexes:
+        print("Rebuilding indexes")
+        for index in secondary:
+            index.create(bind=database.engine, checkfirst=True)
+        database.init_db()
+    with database.engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # ids were assigned explicitly, so move the sequences past them
+            for table in ("users", "items"):
+                conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+    db = database.SessionLocal()
+    try:
+        crud.rebuild_category_counts(db)
+    finally:
+        db.close()
+    print(f"Loaded {users} users, {totals[0]} items, {totals[1]} comments in {time.monotonic() - start:.1f}s (password: {BULK_PASSWORD})")
+    return users, totals[0], totals[1]
+
+
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bulk", action="store_true", help="generate synthetic data instead of the demo rows")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--items-per-user", type=float, default=20, help="mean; per-user counts are log-normal")
+    parser.add_argument("--comments-per-item", type=float, default=2, help="mean; per-item counts are exponential")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="generator processes; SQLite still serializes the writes")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--defer-indexes", action="store_true", help="drop item/comment indexes during the load and rebuild them after")
+    args = parser.parse_args()
+    if args.bulk:
+        bulk(args.users, args.items_per_user, args.comments_per_item, args.seed, args.workers, args.batch_size, args.defer_indexes)
+    else:
+        run()
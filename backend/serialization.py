@@ -0,0 +1,44 @@
+"""Fast JSON for item responses.
+
+Item endpoints build plain dicts straight from ORM rows and send them with
+orjson, instead of going through ``ItemOut.from_orm(...).dict()`` and then
+having FastAPI validate and encode the result again against
+``response_model``. The routes keep ``response_model`` for the OpenAPI
+schema; the dicts here have the same keys as ``ItemOut``.
+
+``item_columns`` turns a page of rows into the compact column-oriented form
+served by ``GET /api/items?format=columns``.
+"""
+import os
+from . import derivatives, models
+
+ITEM_FIELDS = ("id", "title", "category", "description", "owner_id", "created_at", "file_url", "thumb_url", "medium_url")
+
+
+def file_url(path):
+    return f"/uploads/{os.path.basename(path)}" if path else None
+
+
+def comment_row(c: models.Comment) -> dict:
+    return {"id": c.id, "content": c.content, "item_id": c.item_id, "user_id": c.user_id, "created_at": c.created_at}
+
+
+def item_row(it: models.Item, ready=frozenset()) -> dict:
+    """``ready`` is the set of file paths with rendered variants, from ``derivatives.ready_sources``."""
+    return {
+        "id": it.id,
+        "title": it.title,
+        "category": it.category,
+        "description": it.description,
+        "owner_id": it.owner_id,
+        "created_at": it.created_at,
+        "file_url": file_url(it.file_path),
+        **derivatives.variant_urls(it.file_path, it.file_path in ready),
+        "comment_count": None,
+        "latest_comments": None,
+    }
+
+
+def item_columns(rows, fields=ITEM_FIELDS) -> dict:
+    """``{"count": n, "columns": {field: [value per row]}}``; keys are not repeated per row."""
+    return {"count": len(rows), "columns": {field: [row[field] for row in rows] for field in fields}}
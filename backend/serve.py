@@ -0,0 +1,113 @@
+"""Prefork launcher for running several workers on one host.
+
+Usage:
+    python -m backend.serve --workers 4 --host 0.0.0.0 --port 8000
+
+The parent brings the schema up to date once, imports the app and binds
+the listening socket, then forks the workers. Each worker starts with the
+modules already loaded and shared copy-on-write, and with the schema stamp
+already current, so its startup does no DDL. Every worker accepts on the
+same socket and runs the app's lifespan in its own process. Only worker 0
+resumes derivative jobs and runs the storage sweeper.
+
+The parent restarts a worker that dies, and on SIGTERM or SIGINT it stops
+them all. Without ``os.fork`` (Windows) it falls back to uvicorn's own
+``--workers``.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import uvicorn
+from . import database
+
+logger = logging.getLogger(__name__)
+
+
+def _bind(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(index: int, sock: socket.socket, args) -> int:
+    from . import main
+    main.RUN_BACKGROUND_JOBS = index == 0
+    config = uvicorn.Config(main.app, log_level=args.log_level, backlog=args.backlog, lifespan="on")
+    uvicorn.Server(config).run(sockets=[sock])
+    return 0
+
+
+def serve(args) -> int:
+    database.init_db()
+    # connections opened by the schema check must not be shared with the children
+    database.engine.dispose()
+    database.read_engine.dispose()
+    if not hasattr(os, "fork"):
+        uvicorn.run("backend.main:app", host=args.host, port=args.port, workers=args.workers, log_level=args.log_level, backlog=args.backlog)
+        return 0
+
+    from . import main  # noqa: F401  (loaded once here, inherited by every worker)
+    sock = _bind(args.host, args.port, args.backlog)
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                code = _run_worker(index, sock, args)
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(args.workers):
+        spawn(index)
+    logger.info("Serving on %s:%d with %d workers", args.host, args.port, args.workers)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logger.warning("Worker %d exited with status %d; restarting", index, os.waitstatus_to_exitcode(status))
+            # don't spin if workers die right after starting
+            time.sleep(1)
+            spawn(index)
+    sock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API with prefork workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", 1)))
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s: %(message)s")
+    sys.exit(serve(args))
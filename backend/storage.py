@@ -0,0 +1,65 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are streamed to a temporary file in chunks while being hashed, then
+renamed to ``<sha256><ext>`` in ``UPLOAD_DIR``. Identical files therefore
+share one blob, and no upload is ever held in memory as a whole.
+
+Every blob has a row in the ``blobs`` table. ``save_upload`` takes a
+``register`` callback that records the blob before its file is moved into
+place, so the background sweeper (``backend.sweeper``) never sees a file
+without a row.
+"""
+import hashlib
+import os
+import re
+import uuid
+from typing import Awaitable, Callable, Optional
+import aiofiles
+from fastapi import UploadFile
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), "..", "uploads"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds ``MAX_UPLOAD_BYTES``."""
+
+
+def _extension(filename: str) -> str:
+    # keep the extension so StaticFiles can guess the content type
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,10}", ext) else ""
+
+
+async def save_upload(file: UploadFile, register: Optional[Callable[[str, int], Awaitable[None]]] = None) -> str:
+    """Stream ``file`` into the blob store and return the blob's path.
+
+    ``register(path, size)`` is awaited once the content hash is known and
+    before the file is moved into place.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f".tmp-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while True:
+                chunk = await file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                await out.write(chunk)
+        dest = os.path.join(UPLOAD_DIR, digest.hexdigest() + _extension(file.filename))
+        if register is not None:
+            await register(dest, size)
+        # always replace: the sweeper may be removing an old copy of the same content
+        os.replace(tmp_path, dest)
+        return dest
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
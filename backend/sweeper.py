@@ -0,0 +1,154 @@
+"""Background removal of uploaded files that no item references.
+
+Each blob in ``UPLOAD_DIR`` has a row in the ``blobs`` table. Deleting an
+item or replacing its file marks the blob orphaned once no other item
+points at it; re-uploading the same content clears the mark. A daemon
+thread wakes every ``STORAGE_GC_INTERVAL`` seconds and deletes up to
+``STORAGE_GC_BATCH`` blobs that have been orphaned for longer than
+``STORAGE_GC_GRACE_SECONDS``, together with their image variants.
+
+The row is deleted first, with a condition that the blob is still
+orphaned, and only then the file. An upload of the same content registers
+its row before moving its file into place, so when the sweeper finds the
+row back after moving the file aside, it puts the file back instead.
+
+Files written before the table existed can be indexed with::
+
+    python -m backend.sweeper index
+"""
+import argparse
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from . import crud, database, derivatives, models, storage
+
+STORAGE_GC_INTERVAL = float(os.getenv("STORAGE_GC_INTERVAL", 60))
+STORAGE_GC_BATCH = int(os.getenv("STORAGE_GC_BATCH", 100))
+STORAGE_GC_GRACE_SECONDS = float(os.getenv("STORAGE_GC_GRACE_SECONDS", 3600))
+
+logger = logging.getLogger(__name__)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_blob_file(db, path: str):
+    trash = os.path.join(os.path.dirname(path), f".trash-{uuid.uuid4().hex}")
+    try:
+        os.replace(path, trash)
+    except FileNotFoundError:
+        trash = None
+    if crud.blob_exists(db, path):
+        # the same content was uploaded again while we were deleting it
+        if trash is not None and not os.path.exists(path):
+            os.replace(trash, path)
+        elif trash is not None:
+            _remove(trash)
+        return False
+    if trash is not None:
+        _remove(trash)
+    for variant in derivatives.VARIANTS:
+        _remove(derivatives.variant_path(path, variant))
+    return True
+
+
+def sweep_once(grace_seconds: float = STORAGE_GC_GRACE_SECONDS, batch: int = STORAGE_GC_BATCH) -> dict:
+    """Delete orphaned blobs past their grace period; returns counts."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+    result = {"deleted": 0, "bytes": 0, "skipped": 0}
+    db = database.SessionLocal()
+    try:
+        for blob in crud.orphaned_blobs(db, cutoff, batch):
+            path, size = blob.path, blob.size
+            if crud.delete_orphaned_blob(db, path, cutoff) and _remove_blob_file(db, path):
+                result["deleted"] += 1
+                result["bytes"] += size
+            else:
+                result["skipped"] += 1
+    finally:
+        db.close()
+    return result
+
+
+def index_existing(upload_dir: str = None) -> int:
+    """Add rows for blob files that have none; returns the number indexed."""
+    upload_dir = upload_dir or storage.UPLOAD_DIR
+    variant_suffixes = tuple(f".{variant}.jpg" for variant in derivatives.VARIANTS)
+    db = database.SessionLocal()
+    added = 0
+    try:
+        for entry in os.scandir(upload_dir):
+            if not entry.is_file() or entry.name.startswith(".") or entry.name.endswith(variant_suffixes):
+                continue
+            path = os.path.join(upload_dir, entry.name)
+            if crud.blob_exists(db, path):
+                continue
+            crud.register_blob(db, path, entry.stat().st_size)
+            # register_blob marks a new blob orphaned; keep it if an item uses it
+            if db.query(models.Item.id).filter(models.Item.file_path == path).first():
+                crud._claim_blob(db, path)
+                db.commit()
+            added += 1
+    finally:
+        db.close()
+    return added
+
+
+class Sweeper:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.runs = 0
+        self.deleted = 0
+        self.bytes = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="storage-sweeper", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                result = sweep_once()
+            except Exception:
+                logger.exception("Storage sweep failed")
+                continue
+            self.runs += 1
+            self.deleted += result["deleted"]
+            self.bytes += result["bytes"]
+            if result["deleted"]:
+                logger.info("Swept %d orphaned files (%d bytes)", result["deleted"], result["bytes"])
+
+    def shutdown(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "deleted": self.deleted, "bytes": self.bytes}
+
+
+sweeper = Sweeper(STORAGE_GC_INTERVAL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index or sweep the upload blob store.")
+    parser.add_argument("command", choices=("index", "sweep"))
+    parser.add_argument("--grace-seconds", type=float, default=STORAGE_GC_GRACE_SECONDS)
+    args = parser.parse_args()
+    database.init_db()
+    if args.command == "index":
+        print(f"Indexed {index_existing()} files")
+    else:
+        print(sweep_once(args.grace_seconds, batch=1_000_000))
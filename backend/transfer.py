@@ -0,0 +1,198 @@
+"""Streaming export and import of a user's items as NDJSON or CSV.
+
+Export reads rows through a server-side cursor in partitions of
+``EXPORT_BATCH_ROWS`` and encodes each partition as one chunk, so memory
+stays flat however many items a user has. Import parses the request body
+as it arrives and writes valid rows with ``crud.batch_items`` in
+transactions of ``IMPORT_CHUNK_ROWS``; a bad line is reported and skipped
+without failing the rest. Lines and quoted CSV records are capped at
+``IMPORT_MAX_LINE_BYTES``, so a body without newlines or with a stray
+quote costs bounded memory and fails only the lines involved.
+"""
+import csv
+import io
+import os
+from typing import AsyncIterator, Optional
+import orjson
+from pydantic import ValidationError
+from . import crud, crud_async, database, events, schemas, serialization
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", 1000))
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", 1000))
+# longest line, or CSV record with quoted newlines, that import will buffer
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", 64 * 1024))
+MAX_REPORTED_ERRORS = 1000
+EXPORT_FIELDS = ("id", "title", "category", "description", "file_url", "created_at")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _export_row(row) -> dict:
+    return {"id": row.id, "title": row.title, "category": row.category, "description": row.description, "file_url": serialization.file_url(row.file_path), "created_at": row.created_at}
+
+
+async def export_items(owner_id: int, fmt: str) -> AsyncIterator[bytes]:
+    # the session lives inside the generator, for exactly as long as the stream
+    async with database.get_async_session_factory(readonly=True)() as db:
+        result = await db.stream(crud.export_items_query(owner_id).execution_options(yield_per=EXPORT_BATCH_ROWS))
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(EXPORT_FIELDS)
+            async for partition in result.partitions():
+                for row in partition:
+                    r = _export_row(row)
+                    writer.writerow([r["id"], r["title"], r["category"], r["description"], r["file_url"] or "", r["created_at"].isoformat() if r["created_at"] else ""])
+                yield buf.getvalue().encode()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():
+                yield buf.getvalue().encode()
+        else:
+            async for partition in result.partitions():
+                yield b"".join(orjson.dumps(_export_row(row)) + b"\n" for row in partition)
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace").rstrip("\r")
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Optional[str]]:
+    """Yield the body's lines; a line over ``IMPORT_MAX_LINE_BYTES`` yields None and is dropped unread."""
+    parts, size, too_long = [], 0, False
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            piece = chunk[start:end]
+            if too_long or size + len(piece) > IMPORT_MAX_LINE_BYTES:
+                yield None
+            else:
+                parts.append(piece)
+                yield _decode(b"".join(parts))
+            parts, size, too_long = [], 0, False
+            start = end + 1
+        rest = chunk[start:]
+        if too_long or not rest:
+            continue
+        if size + len(rest) > IMPORT_MAX_LINE_BYTES:
+            parts, size, too_long = [], 0, True
+        else:
+            parts.append(rest)
+            size += len(rest)
+    if too_long:
+        yield None
+    elif parts:
+        yield _decode(b"".join(parts))
+
+
+def _csv_fields(text: str):
+    try:
+        return next(csv.reader([text]))
+    except csv.Error as exc:
+        return ValueError(f"invalid CSV: {exc}")
+
+
+async def _csv_records(lines: AsyncIterator[Optional[str]]):
+    """Yield ``(line_number, fields)``; a quoted field may span lines.
+
+    A record that can't be read yields a ``ValueError`` in place of its
+    fields. An unterminated quote ends its record once it grows past
+    ``IMPORT_MAX_LINE_BYTES``, and reading resumes on the next line.
+    """
+    record, size, start, number, quoted = [], 0, None, 0, False
+    async for line in lines:
+        number += 1
+        if line is None:
+            yield (start if record else number), ValueError(f"line longer than {IMPORT_MAX_LINE_BYTES} bytes")
+            record, size, quoted = [], 0, False
+            continue
+        if not record:
+            start = number
+        record.append(line)
+        size += len(line) + 1
+        # quotes inside a field are doubled, so an odd count opens or closes a field
+        if line.count('"') % 2:
+            quoted = not quoted
+        if quoted:
+            if size > IMPORT_MAX_LINE_BYTES:
+                yield start, ValueError("unterminated quoted field")
+                record, size, quoted = [], 0, False
+            continue
+        text = "\n".join(record)
+        record, size = [], 0
+        if text.strip():
+            yield start, _csv_fields(text)
+    if record:
+        yield start, ValueError("unterminated quoted field")
+
+
+async def _ndjson_records(lines: AsyncIterator[Optional[str]]):
+    number = 0
+    async for line in lines:
+        number += 1
+        if line is None:
+            yield number, ValueError(f"line longer than {IMPORT_MAX_LINE_BYTES} bytes")
+        elif line.strip():
+            yield number, line
+
+
+def _parse(fmt: str, header, record):
+    if fmt == "csv":
+        if len(record) > len(header):
+            raise ValueError(f"expected at most {len(header)} fields, got {len(record)}")
+        data = dict(zip(header, record))
+    else:
+        try:
+            data = orjson.loads(record)
+        except orjson.JSONDecodeError as exc:
+            raise ValueError(f"invalid JSON: {exc}") from None
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+    try:
+        item = schemas.ItemCreate(**{k: data[k] for k in ("title", "category", "description") if data.get(k) not in (None, "")})
+    except ValidationError as exc:
+        raise ValueError("; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors())) from None
+    return item.dict()
+
+
+async def import_items(db, owner_id: int, chunks: AsyncIterator[bytes], fmt: str) -> dict:
+    """Import items from a body stream; returns counts and per-line errors."""
+    summary = {"imported": 0, "failed": 0, "chunks": 0, "errors": []}
+    pending = []
+
+    async def flush():
+        result = await crud_async.batch_items(db, owner_id, creates=list(pending))
+        summary["imported"] += len(result["created"])
+        summary["chunks"] += 1
+        pending.clear()
+        # don't let the session's identity map grow with the import
+        db.expunge_all()
+        # progress for clients watching the change feed
+        events.import_progress(owner_id, summary["imported"], summary["failed"])
+
+    lines = _lines(chunks)
+    records = _csv_records(lines) if fmt == "csv" else _ndjson_records(lines)
+    header = None
+    async for number, record in records:
+        if fmt == "csv" and header is None:
+            header = [] if isinstance(record, ValueError) else [h.strip().lower() for h in record]
+            if "title" not in header:
+                summary["errors"].append({"line": number, "detail": "CSV header must include a title column"})
+                summary["failed"] += 1
+                return summary
+            continue
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            pending.append(_parse(fmt, header, record))
+        except ValueError as exc:
+            summary["failed"] += 1
+            if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                summary["errors"].append({"line": number, "detail": str(exc)})
+        if len(pending) >= IMPORT_CHUNK_ROWS:
+            await flush()
+    if pending:
+        await flush()
+    return summary
@@ -0,0 +1,256 @@
+"""Endpoint load test with latency percentiles.
+
+Seeds a throwaway database through the project's own models, starts the app
+under uvicorn against it, and drives the real endpoints concurrently. Prints
+throughput and p50/p95/p99 per endpoint, writes the numbers as JSON, and can
+compare them with an earlier run to catch regressions.
+
+Usage:
+    python -m bench.loadtest --users 20 --items-per-user 500 --concurrency 32 --duration 30 --output bench/results.json
+    python -m bench.loadtest --compare bench/baseline.json --output bench/results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+# relative weights of each scenario in the request mix
+SCENARIOS = {
+    "login": 1,
+    "list_items": 6,
+    "search_items": 3,
+    "create_item": 2,
+    "upload": 1,
+    "stats": 3,
+    "list_comments": 3,
+    "add_comment": 1,
+}
+WORDS = ["report", "invoice", "photo", "travel", "budget", "draft", "summary", "meeting", "archive", "notes"]
+CATEGORIES = ["general", "work", "personal", "finance", "travel", "alpha", "beta"]
+
+
+def seed(database_url: str, users: int, items_per_user: int, comments_per_item: int, seed_value: int):
+    """Create ``users`` accounts with items and comments; returns the credentials."""
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, ROOT)
+    from backend import auth, crud, database, models
+    database.init_db()
+    rng = random.Random(seed_value)
+    password = "benchpass"
+    hashed = auth.get_password_hash(password)
+    credentials = []
+    db = database.SessionLocal()
+    try:
+        for u in range(users):
+            username = f"bench{u}"
+            user = crud.get_user_by_username(db, username) or crud.create_user(db, username, hashed_password=hashed)
+            credentials.append((username, password))
+            for start in range(0, items_per_user, 1000):
+                creates = [
+                    {"title": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {start + i}", "category": rng.choice(CATEGORIES), "description": " ".join(rng.choices(WORDS, k=8))}
+                    for i in range(min(1000, items_per_user - start))
+                ]
+                created = crud.batch_items(db, user.id, creates=creates)["created"]
+                if comments_per_item:
+                    db.bulk_insert_mappings(models.Comment, [
+                        {"content": f"comment {n}", "item_id": item.id, "user_id": user.id}
+                        for item in created for n in range(comments_per_item)
+                    ])
+                    db.commit()
+    finally:
+        db.close()
+    return credentials
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(database_url: str, upload_dir: str, port: int, workers: int) -> subprocess.Popen:
+    # all virtual users share one IP, so per-IP login limits would measure the limiter
+    env = {"RATE_LIMIT_ENABLED": "0", **os.environ, "DATABASE_URL": database_url, "UPLOAD_DIR": upload_dir}
+    cmd = [sys.executable, "-m", "backend.serve", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("server did not start")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def timed(self, name: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.latencies[name].append(time.perf_counter() - start)
+        if not ok:
+            self.errors[name] += 1
+        return response
+
+
+async def virtual_user(client: httpx.AsyncClient, recorder: Recorder, credentials, deadline: float, rng: random.Random):
+    username, password = credentials
+    r = await recorder.timed("login", client.post("/api/login", json={"username": username, "password": password}))
+    if r is None or r.status_code != 200:
+        return
+    headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+    names, weights = zip(*SCENARIOS.items())
+    item_ids = [it["id"] for it in (await client.get("/api/items", params={"limit": 200}, headers=headers)).json()]
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        if name == "login":
+            await recorder.timed(name, client.post("/api/login", json={"username": username, "password": password}))
+        elif name == "list_items":
+            await recorder.timed(name, client.get("/api/items", params={"limit": 50}, headers=headers))
+        elif name == "search_items":
+            await recorder.timed(name, client.get("/api/items", params={"q": rng.choice(WORDS)[:4], "limit": 50}, headers=headers))
+        elif name == "create_item":
+            r = await recorder.timed(name, client.post("/api/items", json={"title": f"{rng.choice(WORDS)} load", "category": rng.choice(CATEGORIES)}, headers=headers))
+            if r is not None and r.status_code == 200:
+                item_ids.append(r.json()["id"])
+        elif name == "upload" and item_ids:
+            body = rng.randbytes(rng.randint(1024, 64 * 1024))
+            await recorder.timed(name, client.post(f"/api/items/{rng.choice(item_ids)}/upload-multipart", files={"file": ("bench.bin", body)}, headers=headers))
+        elif name == "stats":
+            await recorder.timed(name, client.get("/api/stats", headers=headers))
+        elif name == "list_comments" and item_ids:
+            await recorder.timed(name, client.get(f"/api/items/{rng.choice(item_ids)}/comments", params={"limit": 50}, headers=headers))
+        elif name == "add_comment" and item_ids:
+            await recorder.timed(name, client.post(f"/api/items/{rng.choice(item_ids)}/comments", json={"content": "load comment"}, headers=headers))
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    endpoints = {}
+    for name, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        endpoints[name] = {
+            "requests": len(values),
+            "errors": recorder.errors[name],
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "mean_ms": round(1000 * sum(values) / len(values), 2),
+            "p50_ms": round(1000 * percentile(values, 50), 2),
+            "p95_ms": round(1000 * percentile(values, 95), 2),
+            "p99_ms": round(1000 * percentile(values, 99), 2),
+        }
+    return endpoints
+
+
+def compare(baseline: dict, current: dict, threshold: float):
+    """Return human-readable regressions of p95 latency or throughput beyond ``threshold``."""
+    regressions = []
+    for name, now in current["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if before["throughput_rps"] and now["throughput_rps"] < before["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {before['throughput_rps']} -> {now['throughput_rps']} req/s")
+    return regressions
+
+
+async def drive(base_url: str, credentials, concurrency: int, duration: float, seed_value: int):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        start = time.monotonic()
+        deadline = start + duration
+        await asyncio.gather(*(
+            virtual_user(client, recorder, credentials[i % len(credentials)], deadline, random.Random(seed_value + i))
+            for i in range(concurrency)
+        ))
+        elapsed = time.monotonic() - start
+    return summarize(recorder, elapsed)
+
+
+def print_table(endpoints: dict):
+    print(f"{'endpoint':<14}{'reqs':>8}{'errs':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, s in endpoints.items():
+        print(f"{name:<14}{s['requests']:>8}{s['errors']:>6}{s['throughput_rps']:>9}{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--items-per-user", type=int, default=200)
+    parser.add_argument("--comments-per-item", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--database-url", default=None, help="defaults to a fresh SQLite file in a temp dir")
+    parser.add_argument("--output", default=None, help="write results JSON here")
+    parser.add_argument("--compare", default=None, help="baseline results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative regression")
+    parser.add_argument("--keep", action="store_true", help="keep the temp database and uploads")
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix="pt3-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    print(f"Seeding {args.users} users x {args.items_per_user} items into {database_url}")
+    credentials = seed(database_url, args.users, args.items_per_user, args.comments_per_item, args.seed)
+
+    port = _free_port()
+    server = start_server(database_url, os.path.join(tmpdir, "uploads"), port, args.workers)
+    try:
+        print(f"Driving {args.concurrency} concurrent clients for {args.duration}s")
+        endpoints = asyncio.run(drive(f"http://127.0.0.1:{port}", credentials, args.concurrency, args.duration, args.seed))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        if not args.keep:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result = {
+        "meta": {key: getattr(args, key) for key in ("users", "items_per_user", "comments_per_item", "concurrency", "duration", "workers", "seed")},
+        "endpoints": endpoints,
+    }
+    print_table(endpoints)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), result, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -69,7 +69,7 @@ document.getElementById('btn-reg').onclick = async ()=>{
 document.getElementById('btn-login').onclick = async ()=>{
   const u=document.getElementById('login-user').value, p=document.getElementById('login-pass').value
   const res = await post('/login',{username:u,password:p})
-  if(res.access_token){setToken(res.access_token); showApp(); loadItems(); loadStats()}
+  if(res.access_token){setToken(res.access_token); showApp(); loadItems(); loadStats(); startLiveUpdates()}
   else alert(res.detail||JSON.stringify(res))
 }
 
@@ -82,7 +82,7 @@ async function loadMeAndSetup(){
   }catch(e){/* ignore */}
 }
 
-document.getElementById('btn-logout').onclick = ()=>{localStorage.removeItem('pt3_token');showAuth()}
+document.getElementById('btn-logout').onclick = ()=>{localStorage.removeItem('pt3_token');stopLiveUpdates();showAuth()}
 document.getElementById('btn-admin').onclick = async ()=>{
   const users = await get('/admin/users')
   let html = '<button class="close">Close</button><h3>Admin — Users</h3><div><button id="view-audit">View Audit</button></div><div class="admin-list">'
@@ -174,7 +174,7 @@ async function loadItems(page=1){
       const card = document.createElement('div'); card.className='item-card'
       const thumb = document.createElement('div'); thumb.className='item-thumb'
       if(it.file_url && (it.file_url.match(/\.(jpg|jpeg|png|gif)$/i))){
-        const img = document.createElement('img'); img.src = it.file_url; img.style.width='72px'; img.style.height='72px'; img.style.objectFit='cover'; img.style.borderRadius='8px'; thumb.appendChild(img)
+        const img = document.createElement('img'); img.src = it.thumb_url || it.file_url; img.style.width='72px'; img.style.height='72px'; img.style.objectFit='cover'; img.style.borderRadius='8px'; thumb.appendChild(img)
       } else {
         thumb.textContent = (it.title||'').slice(0,2).toUpperCase()
       }
@@ -240,16 +240,37 @@ function showEditModal(it){
   }
 }
 
+async function getCommentPage(itemId, cursor){
+  // comments come in pages; X-Next-Cursor is set while more remain
+  const qs = cursor ? `?cursor=${encodeURIComponent(cursor)}` : ''
+  const r = await fetch(base+`/items/${itemId}/comments${qs}`, {method:'GET', headers:authHeaders()})
+  return {comments: r.ok ? await r.json() : [], next: r.headers.get('X-Next-Cursor')}
+}
+
+function commentHtml(c){
+  return `<div class="comment">${c.content}<br/><small>${new Date(c.created_at).toLocaleString()}</small></div>`
+}
+
 async function showCommentsModal(it){
-  const comments = await get(`/items/${it.id}/comments`)
+  let page = await getCommentPage(it.id)
   let html = '<button class="close">Close</button>'
   html += `<h3>Comments for ${it.title}</h3>`
-  html += '<div class="comments">'
-  if(Array.isArray(comments) && comments.length>0){ comments.forEach(c=> html += `<div class="comment">${c.content}<br/><small>${new Date(c.created_at).toLocaleString()}</small></div>`) }
+  html += '<div class="comments" id="comment-list">'
+  if(page.comments.length>0){ page.comments.forEach(c=> html += commentHtml(c)) }
   else html += '<div class="comment">(no comments)</div>'
   html += '</div>'
+  html += '<button class="btn ghost" id="comments-more">Load more</button>'
   html += '<h4>Add comment</h4><form id="comment-form"><textarea id="c-content" placeholder="Comment"></textarea><button type="submit">Add</button></form>'
   openModal(html)
+  const more = document.getElementById('comments-more')
+  more.style.display = page.next ? '' : 'none'
+  more.onclick = async ()=>{
+    more.disabled = true
+    page = await getCommentPage(it.id, page.next)
+    document.getElementById('comment-list').insertAdjacentHTML('beforeend', page.comments.map(commentHtml).join(''))
+    more.disabled = false
+    more.style.display = page.next ? '' : 'none'
+  }
   document.getElementById('comment-form').onsubmit = async (e)=>{
     e.preventDefault();
     const content = document.getElementById('c-content').value
@@ -295,7 +316,21 @@ document.getElementById('btn-toggle-chart').onclick = ()=>{
   loadStats()
 }
 
+// live updates: refresh (conditional GETs, usually 304) when the server reports a change
+function startLiveUpdates(){
+  stopLiveUpdates()
+  if(!window.EventSource || !getToken()) return
+  const es = new EventSource(base+'/events?access_token='+encodeURIComponent(getToken()))
+  const refresh = ()=>{
+    clearTimeout(window._pt3_live_timer)
+    window._pt3_live_timer = setTimeout(()=>{ loadItems(window._pt3_page||1); loadStats() }, 300)
+  }
+  ;['item.created','item.updated','item.deleted','comment.created','overflow'].forEach(t=>es.addEventListener(t, refresh))
+  window._pt3_events = es
+}
+function stopLiveUpdates(){ if(window._pt3_events){ window._pt3_events.close(); window._pt3_events = null } }
+
 // On load
-if(getToken()){showApp(); loadItems(); loadStats()} else showAuth()
+if(getToken()){showApp(); loadItems(); loadStats(); startLiveUpdates()} else showAuth()
 // try to fetch profile and show admin link
 loadMeAndSetup()
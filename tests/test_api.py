@@ -1,11 +1,22 @@
+import uuid
 import pytest
 from fastapi.testclient import TestClient
 from backend.main import app
 
 
+@pytest.fixture(scope="session")
+def started_app():
+    # entering the client runs the lifespan: schema check, upload dir, background workers
+    with TestClient(app):
+        yield app
+
+
 @pytest.fixture
-def client():
-    return TestClient(app)
+def client(started_app):
+    from backend import ratelimit
+    # every test logs in from the same address; start each with full buckets
+    ratelimit.limiter.reset()
+    return TestClient(started_app)
 
 
 def test_register_login_and_item_flow(client):
@@ -33,3 +44,680 @@ def test_register_login_and_item_flow(client):
     r = client.get('/api/items', headers=headers)
     assert r.status_code == 200
     assert isinstance(r.json(), list)
+
+
+def _auth_headers(client, username=None, password="testpass"):
+    username = username or f"user_{uuid.uuid4().hex[:12]}"
+    client.post('/api/register', json={"username": username, "password": password})
+    r = client.post('/api/login', json={"username": username, "password": password})
+    return {"Authorization": f"Bearer {r.json()['access_token']}", "Content-Type": "application/json"}
+
+
+def test_items_search_and_cursor_pagination(client):
+    headers = _auth_headers(client)
+    for i in range(5):
+        r = client.post('/api/items', json={"title": f"Page {i}", "category": "paging"}, headers=headers)
+        assert r.status_code == 200
+    client.post('/api/items', json={"title": "Other", "category": "paging"}, headers=headers)
+
+    r = client.get('/api/items', params={"q": "page", "sort": "recent"}, headers=headers)
+    assert [it['title'] for it in r.json()] == [f"Page {i}" for i in range(4, -1, -1)]
+
+    seen = []
+    params = {"q": "page", "sort": "recent", "limit": 2}
+    for _ in range(5):
+        r = client.get('/api/items', params=params, headers=headers)
+        assert r.status_code == 200
+        seen += [it['id'] for it in r.json()]
+        if 'x-next-cursor' not in r.headers:
+            break
+        params["cursor"] = r.headers['x-next-cursor']
+    assert len(seen) == 5 and seen == sorted(seen, reverse=True)
+
+    r = client.get('/api/items', params={"cursor": "not-a-cursor"}, headers=headers)
+    assert r.status_code == 400
+    r = client.get('/api/items', params={"cursor": params["cursor"], "offset": 1}, headers=headers)
+    assert r.status_code == 400
+
+
+def test_items_full_text_search(client):
+    headers = _auth_headers(client)
+    r = client.post('/api/items', json={"title": "Quarterly report", "category": "finance", "description": "revenue figures"}, headers=headers)
+    report = r.json()
+    client.post('/api/items', json={"title": "Report report report", "category": "misc", "description": ""}, headers=headers)
+    client.post('/api/items', json={"title": "Holiday photos", "category": "personal", "description": "beach"}, headers=headers)
+
+    titles = lambda q: [it['title'] for it in client.get('/api/items', params={"q": q}, headers=headers).json()]
+    assert titles("revenue") == ["Quarterly report"]
+    assert titles("fin") == ["Quarterly report"]
+    assert titles("report") == ["Report report report", "Quarterly report"]
+    assert titles("beach photo") == ["Holiday photos"]
+
+    client.put(f"/api/items/{report['id']}", json={"title": "Annual summary", "category": "finance"}, headers=headers)
+    assert titles("quarterly") == []
+    assert titles("annual") == ["Annual summary"]
+    client.delete(f"/api/items/{report['id']}", headers=headers)
+    assert titles("annual") == []
+
+
+def test_principal_cache_hits_and_invalidation(client):
+    from backend import auth, crud, database
+    db = database.SessionLocal()
+    try:
+        admin_name = f"admin_{uuid.uuid4().hex[:12]}"
+        crud.create_user(db, admin_name, "adminpass", role="admin")
+    finally:
+        db.close()
+    admin_headers = _auth_headers(client, admin_name, "adminpass")
+    headers = _auth_headers(client)
+    me = client.get('/api/me', headers=headers).json()
+    assert me['role'] == 'user'
+
+    hits = auth.principal_cache.hits
+    client.get('/api/me', headers=headers)
+    assert auth.principal_cache.hits == hits + 1
+
+    r = client.put(f"/api/admin/users/{me['id']}", json={"role": "admin"}, headers=admin_headers)
+    assert r.status_code == 200
+    assert client.get('/api/me', headers=headers).json()['role'] == 'admin'
+
+    r = client.put(f"/api/admin/users/{me['id']}", json={"username": me['username'] + "_renamed"}, headers=admin_headers)
+    assert r.status_code == 200
+    assert client.get('/api/me', headers=headers).status_code == 401
+    stats = client.get('/api/admin/auth-cache', headers=admin_headers).json()
+    assert stats['hits'] >= 1 and stats['misses'] >= 1
+
+
+def test_login_rehashes_outdated_hash_and_sheds_when_saturated(client, monkeypatch):
+    import threading
+    from passlib.context import CryptContext
+    from backend import crud, database, hashing
+    username = f"user_{uuid.uuid4().hex[:12]}"
+    old_hash = CryptContext(schemes=["pbkdf2_sha256"], pbkdf2_sha256__default_rounds=1000).hash("oldpass")
+    db = database.SessionLocal()
+    try:
+        user = crud.create_user(db, username, hashed_password=old_hash)
+        r = client.post('/api/login', json={"username": username, "password": "oldpass"})
+        assert r.status_code == 200
+        db.expire_all()
+        assert crud.get_user_by_id(db, user.id).hashed_password.startswith(f"$pbkdf2-sha256${hashing.PASSWORD_HASH_ROUNDS}$")
+    finally:
+        db.close()
+
+    monkeypatch.setattr(hashing, "_slots", threading.Semaphore(0))
+    r = client.post('/api/login', json={"username": username, "password": "oldpass"})
+    assert r.status_code == 503
+    assert r.headers['retry-after'] == "1"
+
+
+def test_upload_is_content_addressed_and_size_capped(client, tmp_path, monkeypatch):
+    import hashlib
+    import os
+    from backend import storage
+    monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+    headers = _auth_headers(client)
+    auth_only = {"Authorization": headers["Authorization"]}
+    ids = [client.post('/api/items', json={"title": f"Up {i}"}, headers=headers).json()['id'] for i in range(2)]
+    body = b"same bytes" * 1000
+
+    urls = []
+    for item_id in ids:
+        r = client.post(f'/api/items/{item_id}/upload-multipart', files={"file": ("Photo.JPG", body)}, headers=auth_only)
+        assert r.status_code == 200
+        urls.append(r.json()['file_url'])
+    assert urls[0] == urls[1] == f"/uploads/{hashlib.sha256(body).hexdigest()}.jpg"
+    assert os.listdir(tmp_path) == [os.path.basename(urls[0])]
+
+    monkeypatch.setattr(storage, "MAX_UPLOAD_BYTES", 100)
+    r = client.post(f'/api/items/{ids[0]}/upload-multipart', files={"file": ("big.bin", b"x" * 101)}, headers=auth_only)
+    assert r.status_code == 413
+    assert os.listdir(tmp_path) == [os.path.basename(urls[0])]
+
+    # bodies far over the cap are refused before they are spooled
+    from backend import ratelimit
+    monkeypatch.setattr(ratelimit, "MULTIPART_OVERHEAD_BYTES", 1000)
+    r = client.post(f'/api/items/{ids[0]}/upload-multipart', files={"file": ("big.bin", b"x" * 5000)}, headers=auth_only)
+    assert r.status_code == 413 and "Request body" in r.json()['detail']
+
+    async def app(scope, receive, send):
+        await receive()
+        await receive()
+    chunks = iter([{"type": "http.request", "body": b"x" * 700, "more_body": True}, {"type": "http.request", "body": b"x" * 700}])
+    scope = {"type": "http", "method": "POST", "path": "/api/items/1/upload-multipart", "headers": [], "client": ("127.0.0.1", 1)}
+    import asyncio
+    from fastapi import HTTPException
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(ratelimit.AdmissionMiddleware(app)(scope, lambda: asyncio.sleep(0, next(chunks)), None))
+    assert exc.value.status_code == 413
+
+
+def test_unreferenced_uploads_are_swept(client, tmp_path, monkeypatch):
+    import os
+    import uuid
+    from backend import crud, database, storage, sweeper
+    monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+    admin_name = f"admin_{uuid.uuid4().hex[:12]}"
+    db = database.SessionLocal()
+    try:
+        crud.create_user(db, admin_name, "adminpass", role="admin")
+    finally:
+        db.close()
+    admin_headers = _auth_headers(client, admin_name, "adminpass")
+    headers = _auth_headers(client)
+    auth_only = {"Authorization": headers["Authorization"]}
+    ids = [client.post('/api/items', json={"title": f"Gc {i}"}, headers=headers).json()['id'] for i in range(2)]
+    shared, replacement = uuid.uuid4().bytes * 100, uuid.uuid4().bytes * 50
+    for item_id in ids:
+        client.post(f'/api/items/{item_id}/upload-multipart', files={"file": ("a.bin", shared)}, headers=auth_only)
+    shared_name = os.listdir(tmp_path)[0]
+
+    usage = client.get('/api/admin/storage', headers=admin_headers).json()
+    me = client.get('/api/me', headers=headers).json()
+    assert {"user_id": me['id'], "username": me['username'], "files": 1, "bytes": len(shared)} in usage['users']
+
+    # still referenced by the second item
+    assert client.delete(f'/api/items/{ids[0]}', headers=headers).status_code == 200
+    sweeper.sweep_once(grace_seconds=0)
+    assert os.listdir(tmp_path) == [shared_name]
+
+    # replacing the last reference orphans the old blob
+    r = client.post(f'/api/items/{ids[1]}/upload-multipart', files={"file": ("b.bin", replacement)}, headers=auth_only)
+    assert r.status_code == 200
+    assert sweeper.sweep_once(grace_seconds=3600)["deleted"] == 0
+    assert sweeper.sweep_once(grace_seconds=0)["deleted"] >= 1
+    assert os.listdir(tmp_path) == [os.path.basename(r.json()['file_url'])]
+
+    # re-uploading swept content brings the blob back
+    client.post(f'/api/items/{ids[1]}/upload-multipart', files={"file": ("a.bin", shared)}, headers=auth_only)
+    sweeper.sweep_once(grace_seconds=0)
+    assert os.listdir(tmp_path) == [shared_name]
+
+
+def test_image_upload_gets_background_variants(client, tmp_path, monkeypatch):
+    import io
+    import os
+    import time
+    from PIL import Image
+    from backend import storage
+    monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+    headers = _auth_headers(client)
+    item_id = client.post('/api/items', json={"title": "Picture"}, headers=headers).json()['id']
+    buf = io.BytesIO()
+    Image.new("RGB", (1600, 1200), (20, 80, 160)).save(buf, "PNG")
+    r = client.post(f'/api/items/{item_id}/upload-multipart', files={"file": ("pic.png", buf.getvalue())}, headers={"Authorization": headers["Authorization"]})
+    assert r.status_code == 200
+
+    for _ in range(50):
+        item = client.get('/api/items', headers=headers).json()[0]
+        if item['thumb_url'] and item['medium_url']:
+            break
+        time.sleep(0.1)
+    assert item['thumb_url'].endswith('.thumb.jpg')
+    with Image.open(os.path.join(tmp_path, os.path.basename(item['thumb_url']))) as thumb:
+        assert max(thumb.size) == 200
+
+    # readiness comes from the job rows, so listing makes no stat calls
+    from backend import derivatives
+    monkeypatch.setattr(derivatives.os.path, "exists", lambda path: pytest.fail(f"stat of {path}"))
+    assert client.get('/api/items', headers=headers).json()[0]['medium_url'] == item['medium_url']
+
+
+def test_upload_delivery_caching_and_ranges(client, tmp_path, monkeypatch):
+    import hashlib
+    from backend import storage
+    monkeypatch.setattr(storage, "UPLOAD_DIR", str(tmp_path))
+    headers = _auth_headers(client)
+    item_id = client.post('/api/items', json={"title": "Range"}, headers=headers).json()['id']
+    body = bytes(range(256)) * 4
+    r = client.post(f'/api/items/{item_id}/upload-multipart', files={"file": ("data.bin", body)}, headers={"Authorization": headers["Authorization"]})
+    url = r.json()['file_url']
+
+    r = client.get(url)
+    assert r.content == body
+    assert r.headers['etag'] == f'"{hashlib.sha256(body).hexdigest()}.bin"'
+    assert 'immutable' in r.headers['cache-control']
+    assert client.get(url, headers={"If-None-Match": r.headers['etag']}).status_code == 304
+
+    r = client.get(url, headers={"Range": "bytes=10-19"})
+    assert r.status_code == 206 and r.content == body[10:20]
+    assert r.headers['content-range'] == f"bytes 10-19/{len(body)}"
+    r = client.get(url, headers={"Range": "bytes=-4"})
+    assert r.content == body[-4:]
+    assert client.get(url, headers={"Range": f"bytes={len(body)}-"}).status_code == 416
+    assert client.get('/uploads/does-not-exist.txt').status_code == 404
+
+
+def test_index_and_static_assets_served_precompressed(client):
+    import gzip
+    r = client.get('/', headers={"Accept-Encoding": "identity"})
+    assert r.status_code == 200 and b"<html" in r.content.lower()
+    etag = r.headers['etag']
+    assert client.get('/', headers={"Accept-Encoding": "identity", "If-None-Match": etag}).status_code == 304
+
+    r = client.get('/static/app.js', headers={"Accept-Encoding": "gzip"})
+    assert r.headers['content-encoding'] == 'gzip'
+    # each encoding is a different body, so it has its own strong validator
+    gzip_etag = r.headers['etag']
+    assert gzip_etag != client.get('/static/app.js', headers={"Accept-Encoding": "identity"}).headers['etag']
+    assert client.get('/static/app.js', headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}).status_code == 304
+    assert client.get('/static/app.js', headers={"Accept-Encoding": "identity", "If-None-Match": gzip_etag}).status_code == 200
+    assert b"loadItems" in r.content
+    assert client.get('/static/missing.js').status_code == 404
+
+
+def test_stats_counters_follow_item_writes(client):
+    from backend import crud, database
+    headers = _auth_headers(client)
+    ids = [client.post('/api/items', json={"title": f"S{i}", "category": cat}, headers=headers).json()['id'] for i, cat in enumerate(["a", "a", "b"])]
+    assert client.get('/api/stats', headers=headers).json() == {"a": 2, "b": 1}
+
+    client.put(f"/api/items/{ids[0]}", json={"title": "S0", "category": "c"}, headers=headers)
+    client.delete(f"/api/items/{ids[2]}", headers=headers)
+    assert client.get('/api/stats', headers=headers).json() == {"a": 1, "c": 1}
+
+    me = client.get('/api/me', headers=headers).json()
+    db = database.SessionLocal()
+    try:
+        assert crud.verify_category_counts(db, me['id']) == {}
+        assert crud.rebuild_category_counts(db, me['id']) == 2
+        assert crud.stats_items_by_category(db, me['id']) == {"a": 1, "c": 1}
+    finally:
+        db.close()
+
+
+def test_batch_items_single_transaction_with_row_errors(client):
+    headers = _auth_headers(client)
+    r = client.post('/api/items/batch', json={"create": [{"title": f"B{i}", "category": "bulk", "description": "loaded"} for i in range(50)]}, headers=headers)
+    assert r.status_code == 200
+    created = r.json()['created']
+    assert len(created) == 50 and len({it['id'] for it in created}) == 50
+    assert client.get('/api/stats', headers=headers).json() == {"bulk": 50}
+
+    ids = [it['id'] for it in created]
+    r = client.post('/api/items/batch', json={
+        "update": [{"id": ids[0], "title": "B0 renamed", "category": "moved"}, {"id": 10**9, "title": "nope"}],
+        "delete": [ids[1], ids[1], 10**9],
+    }, headers=headers)
+    body = r.json()
+    assert [it['title'] for it in body['updated']] == ["B0 renamed"]
+    assert body['deleted'] == [ids[1]]
+    assert [(e['op'], e['index']) for e in body['errors']] == [("update", 1), ("delete", 1), ("delete", 2)]
+    assert client.get('/api/stats', headers=headers).json() == {"bulk": 48, "moved": 1}
+    assert [it['title'] for it in client.get('/api/items', params={"q": "renamed"}, headers=headers).json()] == ["B0 renamed"]
+
+
+def test_comment_embeds_and_cursor_pages(client):
+    headers = _auth_headers(client)
+    first, second = [client.post('/api/items', json={"title": t}, headers=headers).json()['id'] for t in ("With comments", "Without")]
+    for i in range(5):
+        client.post(f'/api/items/{first}/comments', json={"content": f"c{i}"}, headers=headers)
+
+    items = client.get('/api/items', params={"comment_counts": True, "latest_comments": 2}, headers=headers).json()
+    by_id = {it['id']: it for it in items}
+    assert by_id[first]['comment_count'] == 5
+    assert [c['content'] for c in by_id[first]['latest_comments']] == ["c3", "c4"]
+    assert by_id[second]['comment_count'] == 0 and by_id[second]['latest_comments'] == []
+    assert client.get('/api/items', headers=headers).json()[0]['comment_count'] is None
+
+    seen, params = [], {"limit": 2}
+    for _ in range(5):
+        r = client.get(f'/api/items/{first}/comments', params=params)
+        seen += [c['content'] for c in r.json()]
+        if 'x-next-cursor' not in r.headers:
+            break
+        params["cursor"] = r.headers['x-next-cursor']
+    assert seen == [f"c{i}" for i in range(5)]
+
+
+def test_engine_profile_and_read_only_sessions():
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from backend import database
+    if database.engine.dialect.name != "sqlite":
+        pytest.skip("SQLite profile")
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == database.SQLITE_BUSY_TIMEOUT_MS
+    db = database.ReadSessionLocal()
+    try:
+        assert db.execute(text("SELECT count(*) FROM users")).scalar() >= 0
+        with pytest.raises(OperationalError):
+            db.execute(text("INSERT INTO audits (actor, action) VALUES ('t', 't')"))
+    finally:
+        db.close()
+
+
+def test_admin_audit_is_buffered_and_paged(client):
+    from backend import audit, crud, database
+    db = database.SessionLocal()
+    try:
+        admin_name = f"admin_{uuid.uuid4().hex[:12]}"
+        crud.create_user(db, admin_name, "adminpass", role="admin")
+    finally:
+        db.close()
+    admin_headers = _auth_headers(client, admin_name, "adminpass")
+    target = client.get('/api/me', headers=_auth_headers(client)).json()
+    for role in ("admin", "user", "admin"):
+        assert client.put(f"/api/admin/users/{target['id']}", json={"role": role}, headers=admin_headers).status_code == 200
+    audit.writer.flush()
+
+    r = client.get('/api/admin/audit', params={"actor": admin_name, "limit": 2}, headers=admin_headers)
+    assert r.status_code == 200
+    page = r.json()
+    assert page['total'] == 3
+    assert [e['detail'] for e in page['items']] == ["role=admin", "role=user"]
+    r = client.get('/api/admin/audit', params={"q": admin_name[:10], "offset": 2}, headers=admin_headers)
+    assert [e['detail'] for e in r.json()['items'] if e['actor'] == admin_name] == ["role=admin"]
+    # q also matches a prefix of the action
+    r = client.get('/api/admin/audit', params={"q": "update_us", "actor": admin_name}, headers=admin_headers)
+    assert r.json()['total'] == 3
+
+    stats = client.get('/api/admin/audit/stats', headers=admin_headers).json()
+    assert stats['written'] >= 3 and stats['queued'] == 0 and 'dropped' in stats
+    assert client.get('/api/admin/audit/stats', headers=_auth_headers(client)).status_code == 403
+
+
+def test_metrics_count_requests_and_queries(client):
+    headers = _auth_headers(client)
+    item = client.post('/api/items', json={"title": "m", "category": "metrics"}, headers=headers).json()
+    r = client.get(f"/api/items/{item['id']}/comments", headers=headers)
+    assert r.status_code == 200
+    assert 'db;dur=' in r.headers['server-timing']
+    # the owner's data version, then the comment page
+    assert 'desc="2 queries"' in r.headers['server-timing']
+
+    body = client.get('/metrics').text
+    assert 'http_requests_total{method="GET",route="/api/items/{item_id}/comments",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/api/items",le="+Inf"}' in body
+    assert 'db_queries_total{method="POST",route="/api/login"}' in body
+    assert 'http_requests_in_progress' in body
+
+
+def test_item_fast_path_matches_schema_and_columns_format(client):
+    from backend import schemas
+    headers = _auth_headers(client)
+    for i in range(3):
+        client.post('/api/items', json={"title": f"col{i}", "category": "cols", "description": "x"}, headers=headers)
+    rows = client.get('/api/items', params={"sort": "recent", "limit": 2, "comment_counts": True}, headers=headers)
+    assert rows.status_code == 200
+    assert 'x-next-cursor' in rows.headers
+    for row in rows.json():
+        # same keys as ItemOut, and values it accepts
+        assert set(row) == set(schemas.ItemOut.__fields__)
+        assert schemas.ItemOut(**row).title == row['title']
+        assert row['comment_count'] == 0
+
+    cols = client.get('/api/items', params={"sort": "recent", "limit": 2, "format": "columns"}, headers=headers).json()
+    assert cols['count'] == 2
+    assert cols['columns']['title'] == [r['title'] for r in rows.json()]
+    assert 'comment_count' not in cols['columns']
+    assert client.get('/api/items', params={"format": "csv"}, headers=headers).status_code == 422
+
+
+def test_conditional_get_follows_data_version(client):
+    headers = _auth_headers(client)
+    other = _auth_headers(client)
+    item = client.post('/api/items', json={"title": "v1", "category": "etag"}, headers=headers).json()
+    for url in ('/api/items', '/api/stats', f"/api/items/{item['id']}/comments"):
+        first = client.get(url, headers=headers)
+        etag = first.headers['etag']
+        assert first.headers['cache-control'] == "private, no-cache"
+        r = client.get(url, headers={**headers, "If-None-Match": etag})
+        assert r.status_code == 304 and r.content == b""
+    items_etag = client.get('/api/items', headers=headers).headers['etag']
+    stats_etag = client.get('/api/stats', headers=headers).headers['etag']
+    # different query strings and users never share a tag
+    assert client.get('/api/items', params={"limit": 5}, headers=headers).headers['etag'] != items_etag
+    assert client.get('/api/items', headers={**other, "If-None-Match": items_etag}).status_code == 200
+
+    client.post(f"/api/items/{item['id']}/comments", json={"content": "bump"}, headers=other)
+    assert client.get('/api/items', headers={**headers, "If-None-Match": items_etag}).status_code == 200
+    items_etag = client.get('/api/items', headers=headers).headers['etag']
+    client.put(f"/api/items/{item['id']}", json={"title": "v2", "category": "etag2"}, headers=headers)
+    r = client.get('/api/stats', headers={**headers, "If-None-Match": stats_etag})
+    assert r.status_code == 200 and r.json()["etag2"] == 1
+    assert client.get('/api/items', headers={**headers, "If-None-Match": items_etag}).status_code == 200
+
+
+def test_bulk_seed_loads_searchable_consistent_data(client):
+    from backend import crud, database, seed
+    seed_value = uuid.uuid4().int % 10**9
+    users, items, comments = seed.bulk(5, items_per_user=8, comments_per_item=1, seed=seed_value, batch_size=7)
+    # the load's relaxed durability stays on its own connections
+    from sqlalchemy import text
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+    assert users == 5 and items == sum(seed._item_counts(seed_value, 5, 8))
+    db = database.SessionLocal()
+    try:
+        assert crud.verify_category_counts(db) == {}
+    finally:
+        db.close()
+    headers = _auth_headers(client, f"bulk{seed_value}_0", seed.BULK_PASSWORD)
+    rows = client.get('/api/items', params={"sort": "recent"}, headers=headers).json()
+    assert len(rows) == seed._item_counts(seed_value, 5, 8)[0]
+    if rows:
+        word = rows[0]['title'].split()[0]
+        assert rows[0]['id'] in [r['id'] for r in client.get('/api/items', params={"q": word, "limit": 1000}, headers=headers).json()]
+
+
+def test_change_feed_delivers_deltas_and_drops_slow_consumers(client, monkeypatch):
+    import asyncio
+    from backend import crud, database, events
+
+    db = database.SessionLocal()
+    try:
+        owner_id = crud.create_user(db, f"feed_{uuid.uuid4().hex[:12]}", "pw").id
+        other_id = crud.create_user(db, f"feed_{uuid.uuid4().hex[:12]}", "pw").id
+    finally:
+        db.close()
+
+    def write(fn, *args):
+        db = database.SessionLocal()
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+
+    async def scenario():
+        feed = events.stream(owner_id)
+        assert await feed.__anext__() == b"retry: 2000\n\n"
+        # published from a worker thread, as the sync write paths do
+        item = await asyncio.to_thread(write, crud.create_item_for_user, owner_id, "live", "feed")
+        frame = await asyncio.wait_for(feed.__anext__(), 2)
+        assert b"event: item.created" in frame and b'"title":"live"' in frame
+        monkeypatch.setattr(events.hub, "queue_size", 2)
+        watcher = events.stream(other_id, [item.id])
+        await watcher.__anext__()
+        await asyncio.to_thread(write, crud.create_comment, other_id, item.id, "hello")
+        for gen in (feed, watcher):
+            assert b"event: comment.created" in await asyncio.wait_for(gen.__anext__(), 2)
+        # nobody reads the watcher's queue of 2, so the third event overflows it
+        for n in range(3):
+            await asyncio.to_thread(write, crud.create_comment, owner_id, item.id, f"c{n}")
+        await asyncio.sleep(0.05)
+        assert await watcher.__anext__() == b"event: overflow\ndata: null\n\n"
+        await feed.aclose()
+        with pytest.raises(StopAsyncIteration):
+            await watcher.__anext__()
+
+    asyncio.run(scenario())
+    assert events.hub.stats()["subscribers"] == 0
+
+    assert client.get('/api/events').status_code == 401
+    monkeypatch.setattr(events, "EVENTS_MAX_STREAM_SECONDS", 0.2)
+    token = _auth_headers(client)["Authorization"].split()[1]
+    r = client.get('/api/events', params={"access_token": token})
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith("text/event-stream")
+    assert r.content.startswith(b"retry: 2000")
+
+
+def test_items_stream_export_and_chunked_import(client, monkeypatch):
+    import csv
+    import io
+    import json
+    from backend import transfer
+    monkeypatch.setattr(transfer, "EXPORT_BATCH_ROWS", 2)
+    monkeypatch.setattr(transfer, "IMPORT_CHUNK_ROWS", 2)
+    headers = _auth_headers(client)
+    body = "\n".join([
+        json.dumps({"title": "one", "category": "imp"}),
+        "{not json",
+        json.dumps({"title": "two", "description": "multi\nline"}),
+        json.dumps({"category": "no title"}),
+        json.dumps({"title": "three", "category": "imp"}),
+    ]).encode()
+    r = client.post('/api/items/import', content=body, headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    summary = r.json()
+    assert (summary['imported'], summary['failed'], summary['chunks']) == (3, 2, 2)
+    assert [e['line'] for e in summary['errors']] == [2, 4]
+
+    r = client.get('/api/items/export', headers=headers)
+    assert r.headers['content-type'].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert [row['title'] for row in rows] == ["one", "two", "three"]
+
+    r = client.get('/api/items/export', params={"format": "csv"}, headers=headers)
+    exported = list(csv.DictReader(io.StringIO(r.text)))
+    assert exported[1]['description'] == "multi\nline"
+
+    # a CSV export imports back, quoted newlines included
+    other = _auth_headers(client)
+    r = client.post('/api/items/import', content=r.content, headers={**other, "Content-Type": "text/csv"})
+    assert r.json()['imported'] == 3 and r.json()['errors'] == []
+    assert client.get('/api/stats', headers=other).json() == {"imp": 2, "general": 1}
+
+
+def test_import_bounds_long_lines_and_stray_quotes(client, monkeypatch):
+    import json
+    from backend import transfer
+    monkeypatch.setattr(transfer, "IMPORT_MAX_LINE_BYTES", 200)
+    headers = _auth_headers(client)
+    # a stray quote swallows lines only until the record hits the cap, then reading resyncs
+    rows = ["title,category", 'stray "quote,x'] + [f"row {i},csv" for i in range(100)]
+    r = client.post('/api/items/import', content="\n".join(rows).encode(), headers={**headers, "Content-Type": "text/csv"})
+    assert r.status_code == 200
+    summary = r.json()
+    assert summary['errors'][0] == {"line": 2, "detail": "unterminated quoted field"}
+    assert summary['failed'] == 1 and 75 <= summary['imported'] < 100
+
+    body = b"\n".join([json.dumps({"title": "x" * 500}).encode(), b"y" * 100_000, json.dumps({"title": "ok"}).encode()])
+    r = client.post('/api/items/import', content=body, headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    assert (r.json()['imported'], [e['line'] for e in r.json()['errors']]) == (1, [1, 2])
+
+
+def test_admission_control_limits_and_sheds(client, monkeypatch, tmp_path):
+    from backend import ratelimit
+    login = ratelimit.limiter.classes["login"]
+    monkeypatch.setattr(login, "ip_rate", ratelimit.Rate("3/60"))
+    attempts = [client.post('/api/login', json={"username": f"nobody{i}", "password": "x"}) for i in range(4)]
+    assert [r.status_code for r in attempts] == [400, 400, 400, 429]
+    assert int(attempts[-1].headers['retry-after']) >= 1
+
+    ratelimit.limiter.reset()
+    monkeypatch.setattr(ratelimit.limiter, "account_rate", ratelimit.Rate("2/60"))
+    codes = [client.post('/api/login', json={"username": "stuffed", "password": "x"}).status_code for _ in range(3)]
+    assert codes == [400, 400, 429]
+
+    upload = ratelimit.limiter.classes["upload"]
+    monkeypatch.setattr(upload, "in_flight", upload.concurrency)
+    r = client.post('/api/items/1/upload-multipart', files={"file": ("a.txt", b"a")})
+    assert r.status_code == 503 and r.headers['retry-after'] == "1"
+    stats = ratelimit.limiter.stats()
+    assert stats["login"]["rejected_account"] == 1 and stats["upload"]["shed_concurrency"] == 1
+    assert 'admission_requests_total{route_class="upload",outcome="shed_concurrency"} 1' in client.get('/metrics').text
+
+    # the SQLite store is shared by separate store instances, as by separate workers
+    path = str(tmp_path / "buckets.db")
+    a, b = ratelimit.SQLiteBucketStore(path), ratelimit.SQLiteBucketStore(path)
+    rate = ratelimit.Rate("2/60")
+    assert a.take("k", rate) == 0 and b.take("k", rate) == 0
+    assert a.take("k", rate) > 0
+
+    # a busy store falls back to a local bucket instead of letting requests through
+    import sqlite3
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        assert a.take("busy", rate) == 0 and a.take("busy", rate) == 0
+        assert a.take("busy", rate) > 0 and a.fallbacks == 3
+    finally:
+        blocker.execute("ROLLBACK")
+
+
+def test_forwarded_for_uses_the_proxy_appended_hop(monkeypatch):
+    from backend import ratelimit
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUST_FORWARDED", True)
+    scope = {"client": ("10.0.0.1", 1234), "headers": [(b"x-forwarded-for", b"6.6.6.6, 1.2.3.4")]}
+    assert ratelimit._client_ip(scope) == "1.2.3.4"
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_PROXY_HOPS", 2)
+    assert ratelimit._client_ip(scope) == "6.6.6.6"
+    assert ratelimit._client_ip({**scope, "headers": []}) == "10.0.0.1"
+
+
+IMPORT_BUDGET_SECONDS = 2.0
+
+
+def test_import_does_no_io_and_fits_budget(tmp_path):
+    import json
+    import os
+    import subprocess
+    import sys
+    code = "import time; t = time.perf_counter(); import backend.main; print(time.perf_counter() - t)"
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path / 'cold.db'}", "UPLOAD_DIR": str(tmp_path / "uploads")}
+    out = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.dirname(__file__)), capture_output=True, text=True, check=True)
+    assert float(out.stdout) < IMPORT_BUDGET_SECONDS
+    assert os.listdir(tmp_path) == []
+
+    # the first startup creates the schema, later ones only read the stamp
+    code = "from backend import database; print(json.dumps([database.init_db(), database.init_db()]))"
+    runs = [json.loads(subprocess.run([sys.executable, "-c", "import json; " + code], env=env, cwd=os.path.dirname(os.path.dirname(__file__)), capture_output=True, text=True, check=True).stdout) for _ in range(2)]
+    assert runs == [[True, False], [False, False]]
+
+
+def test_concurrent_first_starts_create_schema_once(tmp_path):
+    import os
+    import subprocess
+    import sys
+    import time
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path / 'race.db'}"}
+    # line the processes up on a shared start time so their init_db calls overlap
+    code = f"import time; from backend import database; time.sleep(max(0, {time.time() + 3} - time.time())); print(database.init_db())"
+    procs = [subprocess.Popen([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.dirname(__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) for _ in range(8)]
+    results = [proc.communicate(timeout=60) + (proc.returncode,) for proc in procs]
+    assert [code for _, _, code in results] == [0] * 8, [err for _, err, _ in results]
+    assert sorted(out.strip() for out, _, _ in results) == ["False"] * 7 + ["True"]
+
+
+def test_prefork_launcher_serves_from_shared_socket(tmp_path):
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    import httpx
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path / 'served.db'}", "UPLOAD_DIR": str(tmp_path / "uploads"), "RATE_LIMIT_ENABLED": "0"}
+    proc = subprocess.Popen([sys.executable, "-m", "backend.serve", "--workers", "2", "--port", str(port), "--log-level", "warning"], env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                r = httpx.post(f"http://127.0.0.1:{port}/api/register", json={"username": "prefork", "password": "testpass"}, timeout=5)
+                break
+            except httpx.HTTPError:
+                assert time.monotonic() < deadline, "server did not start"
+                time.sleep(0.2)
+        assert r.status_code == 200
+        for _ in range(10):
+            assert httpx.post(f"http://127.0.0.1:{port}/api/login", json={"username": "prefork", "password": "testpass"}, timeout=5).status_code == 200
+        assert os.path.isdir(tmp_path / "uploads")
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=15) == 0